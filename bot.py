@@ -1,22 +1,62 @@
 import asyncio
 import logging
 import threading
+import time
 from datetime import datetime, timedelta
 
 import discord
-import requests
-import spotipy
-from commons.config import Config, bot_discord, loop_flags, queues, user_tokens, voice_clients
+from commons import metrics
+from commons.config import (
+    Config,
+    bot_discord,
+    cluster,
+    guild_states,
+    http_client,
+    loop_watchdog,
+    spotify_client,
+    token_service,
+)
 from commons.db import MongoDB
 from discord.ext import commands
 from dotenv import load_dotenv
 from fastapi_app.app import run_fastapi
-from play_music.bot_music import ensure_voice, format_duration, handle_spotify_playlist, handle_youtube
-from spotipy.oauth2 import SpotifyOAuth
+from play_music.audio import gap_stats
+from play_music.bot_music import (
+    audio_cache,
+    cancel_playlist_imports,
+    ensure_voice,
+    extractor_pool,
+    format_duration,
+    format_queue_summary,
+    handle_spotify_playlist,
+    handle_youtube,
+    resolution_cache,
+    single_flight,
+)
+from spotify_operations.batch import fetch_tracks
 
 STATUS_URL = "http://localhost:8000/current-status"  # URL del endpoint de consulta de estado
+NGROK_TUNNELS_URL = "http://127.0.0.1:4040/api/tunnels"  # API local de ngrok
 load_dotenv()
 
+# Última respuesta de ngrok, reutilizada durante NGROK_TUNNELS_TTL segundos
+ngrok_tunnels_cache = {"data": None, "expires_at": 0}
+ngrok_tunnels_lock = asyncio.Lock()
+
+
+async def get_ngrok_tunnels():
+    """
+    Consulta los túneles activos de ngrok, con caché de corta duración.
+    """
+    async with ngrok_tunnels_lock:
+        if ngrok_tunnels_cache["data"] is not None and time.monotonic() < ngrok_tunnels_cache["expires_at"]:
+            return ngrok_tunnels_cache["data"]
+        data = await http_client.get_json(NGROK_TUNNELS_URL, timeout=Config.LOCAL_HTTP_TIMEOUT)
+        ngrok_tunnels_cache["data"] = data
+        ngrok_tunnels_cache["expires_at"] = time.monotonic() + Config.NGROK_TUNNELS_TTL
+        return data
+
+
 @bot_discord.command(name="check_voice_perms")
 async def check_voice_perms(ctx):
     perms = ctx.author.voice.channel.permissions_for(ctx.guild.me)
@@ -56,13 +96,31 @@ async def on_ready():
     logging.info(f"Bot conectado como {bot_discord.user}")
 
 
+@bot_discord.before_invoke
+async def start_command_timer(ctx):
+    ctx.command_started_at = time.perf_counter()
+
+
+@bot_discord.after_invoke
+async def observe_command_duration(ctx):
+    command = ctx.command.qualified_name
+    metrics.command_duration.observe(time.perf_counter() - ctx.command_started_at, command=command)
+    if ctx.command_failed:
+        metrics.command_errors.inc(command=command)
+    if loop_watchdog.fail_fast:
+        # Hace fallar de forma visible al comando que bloqueó el loop
+        loop_watchdog.check()
+
+
 # Comando 'status'
 @bot_discord.command(name="status")
 async def status(ctx):
     try:
-        response = requests.get(STATUS_URL)
-        status = response.json().get("status", "No status available")
+        response_data = await http_client.get_json(STATUS_URL, timeout=Config.LOCAL_HTTP_TIMEOUT)
+        status = response_data.get("status", "No status available")
         await ctx.send(f"Status del servidor: {status}")
+    except asyncio.TimeoutError:
+        await ctx.send("El servidor de estado no respondió a tiempo.")
     except Exception as e:
         logging.exception("Error al obtener el estado")
         await ctx.send(f"Error al obtener el estado: {e}")
@@ -72,8 +130,7 @@ async def status(ctx):
 @bot_discord.command(name="ip_server")
 async def ip_server(ctx):
     try:
-        response = requests.get("http://127.0.0.1:4040/api/tunnels")
-        response_data = response.json()
+        response_data = await get_ngrok_tunnels()
 
         for tunnel in response_data.get("tunnels", []):
             if tunnel.get("proto") == "tcp":
@@ -81,6 +138,8 @@ async def ip_server(ctx):
                 await ctx.send(f"IP del servidor: {public_url}")
                 return
         await ctx.send("No se encontró un túnel TCP activo.")
+    except asyncio.TimeoutError:
+        await ctx.send("ngrok no respondió a tiempo.")
     except Exception as e:
         logging.exception("Error al obtener la IP del servidor")
         await ctx.send(f"Error: {e}")
@@ -97,7 +156,7 @@ async def play(ctx, *, query):
         is_loop = True
         query = query.replace(" loop", "")
 
-    loop_flags[guild_id] = is_loop
+    guild_states.get(guild_id).loop = is_loop
 
     # Verificar si el usuario está en un canal de voz
     if not ctx.author.voice:
@@ -112,11 +171,11 @@ async def play(ctx, *, query):
 
     # Manejar playlist de Spotify
     if "open.spotify.com/playlist/" in query:
-        await handle_spotify_playlist(ctx, query, voice_client, is_loop)
+        await handle_spotify_playlist(ctx, query, voice_client, is_loop, requested_at=ctx.command_started_at)
         return
 
     # Manejar enlace o búsqueda de YouTube
-    await handle_youtube(ctx, query, voice_client, is_loop)
+    await handle_youtube(ctx, query, voice_client, is_loop, requested_at=ctx.command_started_at)
 
 
 # Comando 'pause'
@@ -145,11 +204,10 @@ async def resume(ctx):
 @bot_discord.command(name="stop")
 async def stop(ctx):
     voice_client = ctx.voice_client
+    cancel_playlist_imports(ctx.guild.id)
     if voice_client and voice_client.is_connected():
         await voice_client.disconnect()
-        voice_clients.pop(ctx.guild.id, None)
-        queues.pop(ctx.guild.id, None)
-        loop_flags.pop(ctx.guild.id, None)
+        guild_states.discard(ctx.guild.id)
         await ctx.send("Deteniendo la reproducción y saliendo del canal de voz.")
     else:
         await ctx.send("No estoy conectado a ningún canal de voz.")
@@ -158,14 +216,15 @@ async def stop(ctx):
 # Comando 'queue'
 @bot_discord.command(name="queue")
 async def show_queue(ctx):
-    guild_id = ctx.guild.id
-    if guild_id in queues and queues[guild_id]:
-        queue_list = queues[guild_id]
+    queue = guild_states.get(ctx.guild.id).queue
+    if queue:
         queue_message = ""
-        for i, song in enumerate(queue_list[:10], 1):
-            queue_message += f"{i}. {song['title']} - {format_duration(song['duration'])}\n"
+        for i, song in enumerate(queue.head(10), 1):
+            queue_message += f"{i}. {song.title} - {format_duration(song.duration)}\n"
         embed = discord.Embed(title="🎶 Canciones en cola", description=queue_message, color=discord.Color.green())
-        embed.set_footer(text=f"Mostrando las primeras {min(10, len(queue_list))} canciones")
+        embed.set_footer(
+            text=f"Mostrando las primeras {min(10, len(queue))} de {format_queue_summary(queue)}"
+        )
         await ctx.send(embed=embed)
     else:
         await ctx.send("La cola está vacía.")
@@ -177,7 +236,7 @@ async def skip(ctx):
     voice_client = ctx.voice_client
     guild_id = ctx.guild.id
     if voice_client and voice_client.is_playing():
-        loop_flags[guild_id] = False  # Desactivar loop
+        guild_states.get(guild_id).loop = False  # Desactivar loop
         voice_client.stop()
         await ctx.send("Canción actual saltada.")
     else:
@@ -188,27 +247,62 @@ async def skip(ctx):
 @bot_discord.command(name="clear_queue")
 async def clear_queue(ctx):
     guild_id = ctx.guild.id
-    if guild_id in queues:
-        queues[guild_id].clear()
+    cancel_playlist_imports(guild_id)
+    queue = guild_states.get(guild_id).queue
+    if queue:
+        queue.clear()
         await ctx.send("Cola borrada.")
     else:
         await ctx.send("La cola ya está vacía.")
 
 
+# Comando 'remove'
+@bot_discord.command(name="remove")
+async def remove(ctx, posicion: int):
+    queue = guild_states.get(ctx.guild.id).queue
+    if not queue or not 1 <= posicion <= len(queue):
+        await ctx.send("Posición inválida.")
+        return
+    song = queue.remove(posicion - 1)
+    await ctx.send(f"Se quitó **{song.title}** de la cola.")
+
+
+# Comando 'move'
+@bot_discord.command(name="move")
+async def move(ctx, desde: int, hasta: int):
+    queue = guild_states.get(ctx.guild.id).queue
+    if not queue or not 1 <= desde <= len(queue) or not 1 <= hasta <= len(queue):
+        await ctx.send("Posición inválida.")
+        return
+    song = queue.move(desde - 1, hasta - 1)
+    await ctx.send(f"**{song.title}** ahora está en la posición {hasta}.")
+
+
+# Comando 'shuffle'
+@bot_discord.command(name="shuffle")
+async def shuffle(ctx):
+    queue = guild_states.get(ctx.guild.id).queue
+    if not queue:
+        await ctx.send("La cola está vacía.")
+        return
+    queue.shuffle()
+    await ctx.send("Cola mezclada.")
+
+
 @bot_discord.command(name="recomendar")
 async def recomendar(ctx, tipo: str = "cancion"):
     user_id = ctx.author.id
+    # El token sale de memoria (ya renovado en segundo plano)
+    access_token = await token_service.get_access_token(user_id)
+    if access_token is None:
+        await ctx.send("Por favor, inicia sesión primero usando el comando `>login`.")
+        return
+    sp = spotify_client.as_user(access_token)
+
     mongo = MongoDB("bot_spotipy")
-    user_data = await mongo.find_document({"user_id": str(user_id)}, "users")
-    sp_oauth = SpotifyOAuth(
-        client_id=Config.SPOTIPY_CLIENT_ID,
-        client_secret=Config.SPOTIPY_CLIENT_SECRET,
-        redirect_uri=Config.SPOTIPY_REDIRECT_URI,
+    user_data = await mongo.find_document(
+        {"user_id": str(user_id)}, "users", projection={"top_tracks": True, "listened_tracks": True}
     )
-    token_info = sp_oauth.validate_token(user_data["token_info"])
-    user_data["token_info"] = token_info
-    user_data = await mongo.update_document("users", {"user_id": str(user_id)}, update={"$set": user_data})
-    sp = spotipy.Spotify(auth=user_data["token_info"]["access_token"])
 
     if user_data and "top_tracks" in user_data:
         # Obtén las canciones y artistas favoritos
@@ -220,8 +314,12 @@ async def recomendar(ctx, tipo: str = "cancion"):
         seed_artists = set()
         seed_genres = set()  # Esto será un conjunto para evitar duplicados
 
+        # Una sola llamada por cada 50 canciones en lugar de una por canción
+        tracks_info = await fetch_tracks(sp, top_tracks)
         for track_id in top_tracks:
-            track_info = sp.track(track_id)
+            track_info = tracks_info.get(track_id)
+            if not track_info:
+                continue
             # seed_tracks.append(track_id)  # ID de la canción
             seed_artists.add(track_info["artists"][0]["id"])  # Asumiendo que tomas el primer artista
             # Aquí puedes agregar lógica para obtener géneros, si es necesario
@@ -229,7 +327,7 @@ async def recomendar(ctx, tipo: str = "cancion"):
 
         # Llama a la función de recomendaciones de Spotipy
         try:
-            recommendations = sp.recommendations(
+            recommendations = await sp.recommendations(
                 seed_tracks=seed_tracks,
                 seed_artists=list(seed_artists)[:5],  # Convertir a lista
                 seed_genres=list(seed_genres)[:5],  # Convertir a lista (vacío por ahora)
@@ -277,21 +375,16 @@ async def login(ctx):
     """
     Inicia el proceso de autenticación de Spotify.
     """
-    sp_oauth = SpotifyOAuth(
-        client_id=Config.SPOTIPY_CLIENT_ID,
-        client_secret=Config.SPOTIPY_CLIENT_SECRET,
-        redirect_uri=Config.SPOTIPY_REDIRECT_URI,
-        scope="user-top-read",
-    )
     try:
         if not Config.DEBUG:
-            response = requests.get("http://127.0.0.1:4040/api/tunnels")
-            response_data = response.json()
+            await get_ngrok_tunnels()
     except Exception as e:
         await ctx.send("Servicio de login inactivo, contacte al administrator")
         return
 
-    auth_url = sp_oauth.get_authorize_url(state=str(ctx.author.id))
+    auth_url = spotify_client.authorize_url(
+        Config.SPOTIPY_REDIRECT_URI, scope="user-top-read", state=str(ctx.author.id)
+    )
     await ctx.send(f"Por favor, autentícate usando este enlace: {auth_url}")
 
 
@@ -300,17 +393,19 @@ async def mis_preferencias(ctx):
     user_id = str(ctx.author.id)
 
     # Verifica que el usuario esté autenticado
-    if user_id not in user_tokens:
+    access_token = await token_service.get_access_token(user_id)
+    if access_token is None:
         await ctx.send("Por favor, inicia sesión primero usando el comando `>login`.")
         return
 
-    # Obtén el token de acceso y configura el cliente de Spotify
-    token_info = user_tokens[user_id]
-    sp = spotipy.Spotify(auth=token_info["access_token"])
+    # Configura el cliente de Spotify con el token del usuario
+    sp = spotify_client.as_user(access_token)
 
     # Obtén las canciones o artistas favoritos
-    top_tracks = sp.current_user_top_tracks(limit=10)  # puedes ajustar el límite según prefieras
-    top_artists = sp.current_user_top_artists(limit=10)
+    top_tracks, top_artists = await asyncio.gather(
+        sp.current_user_top_tracks(limit=10),  # puedes ajustar el límite según prefieras
+        sp.current_user_top_artists(limit=10),
+    )
 
     # Muestra la lista de canciones y artistas favoritos
     track_names = [track["name"] for track in top_tracks["items"]]
@@ -448,17 +543,31 @@ async def tiempo_faltante(ctx):
 @bot_discord.command(name="shutdown_notice")
 async def shutdown_notice(ctx, minutos: int = 15):
     """
-    Envía un mensaje de aviso de cierre a todos los servidores donde está el bot.
+    Envía un mensaje de aviso de cierre a todos los servidores donde está el bot,
+    en todos los clusters.
+    """
+    if ctx.author.id != Config.ADMIN_ID:
+        await ctx.send("No tienes permisos para ejecutar este comando.")
+        return
+
+    try:
+        results = await cluster.broadcast("shutdown_notice", minutos=minutos)
+    except asyncio.TimeoutError:
+        await ctx.send("Los clusters no respondieron a tiempo.")
+        return
+    notified_servers = sum(result or 0 for result in results)
+    await ctx.send(f"Mensaje de cierre enviado a {notified_servers} servidores ({len(results)} clusters).")
+
+
+@cluster.handler("shutdown_notice")
+async def notify_shutdown(minutos):
+    """
+    Avisa del cierre en los servidores de este cluster; devuelve cuántos se notificaron.
     """
     message_content = f"⚠️ El bot se apgagara en {minutos} minutos."
-    author = ctx.author.id
     delete_delay = 300  # 5 minutos en segundos
     notified_servers = 0
 
-    if author != Config.ADMIN_ID:
-        await ctx.send("No tienes permisos para ejecutar este comando.")
-        return
-
     for guild in bot_discord.guilds:
         # if guild.id != 971889659468722288: # Server de pruebas
         #     continue
@@ -473,7 +582,96 @@ async def shutdown_notice(ctx, minutos: int = 15):
                 except Exception as e:
                     print(f"Error al enviar mensaje a {guild.name}: {e}")
                 break  # Solo envía al primer canal encontrado con permisos
-    await ctx.send(f"Mensaje de cierre enviado a ", "-".join([sv.name for sv in bot_discord.guilds]), " servidores.")
+    return notified_servers
+
+
+@bot_discord.command(name="estado_servidores")
+async def estado_servidores(ctx):
+    """
+    Muestra cuánta memoria ocupa el estado de cada servidor (solo administrador).
+    """
+    if ctx.author.id != Config.ADMIN_ID:
+        await ctx.send("No tienes permisos para ejecutar este comando.")
+        return
+
+    stats = guild_states.metrics()
+    top_guilds = sorted(stats["guild_bytes"].items(), key=lambda item: item[1], reverse=True)[:10]
+    lines = [f"{guild_id}: {size / 1024:.1f} KiB" for guild_id, size in top_guilds]
+    embed = discord.Embed(title="Estado por servidor", description="\n".join(lines) or "Sin estado.")
+    embed.add_field(name="Servidores", value=stats["guilds"], inline=True)
+    embed.add_field(name="Memoria", value=f"{stats['total_bytes'] / 1024:.1f} KiB", inline=True)
+    embed.add_field(name="Expulsados", value=stats["evictions"], inline=True)
+    embed.add_field(name="Desconexiones por inactividad", value=stats["idle_disconnects"], inline=True)
+    embed.add_field(
+        name="Pausa entre canciones",
+        value=f"prom. {gap_stats.average * 1000:.0f} ms / máx. {gap_stats.max * 1000:.0f} ms ({gap_stats.count})",
+        inline=True,
+    )
+    watchdog_stats = loop_watchdog.stats()
+    embed.add_field(
+        name="Bloqueos del event loop",
+        value=", ".join(f"{command}: {count}" for command, count in watchdog_stats["stalls"].items()) or "Ninguno",
+        inline=True,
+    )
+    spotify_stats = spotify_client.stats()
+    embed.add_field(
+        name="Spotify",
+        value=f"{spotify_stats['throttled']} respuestas 429, en espera {spotify_stats['blocked_for']:.0f}s",
+        inline=True,
+    )
+    extractor_stats = extractor_pool.stats()
+    embed.add_field(
+        name="yt-dlp",
+        value=f"{extractor_stats['busy']}/{extractor_stats['workers']} ocupados, {extractor_stats['pending']} en espera - "
+        f"espera prom. {extractor_stats['average_wait']:.1f}s, {extractor_stats['timeouts']} timeouts, "
+        f"{extractor_stats['rejected']} rechazadas",
+        inline=False,
+    )
+    await ctx.send(embed=embed)
+
+
+@bot_discord.command(name="estado_cache")
+async def estado_cache(ctx):
+    """
+    Muestra las estadísticas de las cachés de YouTube y de audio (solo administrador).
+    """
+    if ctx.author.id != Config.ADMIN_ID:
+        await ctx.send("No tienes permisos para ejecutar este comando.")
+        return
+
+    embed = discord.Embed(title="Cachés", color=discord.Color.blue())
+    resolution_stats = resolution_cache.stats()
+    embed.add_field(
+        name="Búsquedas",
+        value=f"memoria {resolution_stats['query_memory_hits']} / disco {resolution_stats['query_disk_hits']} / "
+        f"fallos {resolution_stats['query_misses']}",
+        inline=False,
+    )
+    embed.add_field(
+        name="Metadatos",
+        value=f"memoria {resolution_stats['metadata_memory_hits']} / disco {resolution_stats['metadata_disk_hits']} / "
+        f"fallos {resolution_stats['metadata_misses']}",
+        inline=False,
+    )
+    flight_stats = single_flight.stats()
+    embed.add_field(
+        name="Llamadas agrupadas",
+        value=" / ".join(
+            f"{kind} {flight_stats['saved'].get(kind, 0)} de {flight_stats['saved'].get(kind, 0) + calls}"
+            for kind, calls in flight_stats["calls"].items()
+        )
+        or "Sin llamadas.",
+        inline=False,
+    )
+    if audio_cache:
+        audio_stats = audio_cache.stats()
+        embed.add_field(
+            name="Audio",
+            value=f"{audio_stats['files']} archivos, {audio_stats['bytes'] / 1024**2:.1f} MiB - "
+            f"aciertos {audio_stats['hit_ratio']:.0%}, ahorrados {audio_stats['bytes_saved'] / 1024**2:.1f} MiB",
+            inline=False,
+        )
+    await ctx.send(embed=embed)
 
 
 async def delete_message_later(message, delay):
@@ -488,8 +686,8 @@ async def delete_message_later(message, delay):
 
 
 if __name__ == "__main__":
-    # print("fast api up")
-    # fastapi_thread = threading.Thread(target=run_fastapi)
-    # fastapi_thread.start()
+    if Config.FASTAPI_IN_PROCESS:
+        fastapi_thread = threading.Thread(target=run_fastapi, daemon=True)
+        fastapi_thread.start()
 
     bot_discord.run(Config.TOKEN_DISCORD)
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+import uuid
+
+
+class ClusterClient:
+    """
+    Canal IPC de un cluster (proceso con un grupo de shards) con el lanzador.
+    Envía heartbeats periódicos y permite difundir eventos a todos los
+    clusters, por ejemplo el aviso de cierre del bot.
+
+    Si el bot corre sin lanzador (python bot.py) los eventos solo se
+    ejecutan en este proceso.
+    """
+
+    def __init__(self, heartbeat_interval=10, timeout=30):
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self.cluster_id = 0
+        self._conn = None
+        self._bot = None
+        self._handlers = {}
+        self._pending = {}  # nonce -> future con los resultados de una difusión
+        self._task = None
+
+    @property
+    def attached(self):
+        return self._conn is not None
+
+    def attach(self, conn, cluster_id):
+        """
+        Lo llama el lanzador en el proceso hijo, antes de iniciar el bot.
+        """
+        self._conn = conn
+        self.cluster_id = cluster_id
+
+    def handler(self, event):
+        """
+        Registra una corrutina que atiende un evento difundido; recibe el
+        payload como kwargs y lo que devuelve se envía al que lo difundió.
+        """
+
+        def decorator(func):
+            self._handlers[event] = func
+            return func
+
+        return decorator
+
+    def start(self, bot):
+        if not self.attached or self._task is not None:
+            return
+        self._bot = bot
+        asyncio.get_running_loop().add_reader(self._conn.fileno(), self._on_readable)
+        self._task = asyncio.create_task(self._heartbeat())
+
+    def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        try:
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+        except (OSError, ValueError):
+            pass
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def status(self):
+        bot = self._bot
+        return {
+            "ready": bot.is_ready(),
+            "guilds": len(bot.guilds),
+            "voice_clients": len(bot.voice_clients),
+            "latency": bot.latency,
+            "shard_ids": getattr(bot, "shard_ids", None),
+            "sent_at": time.time(),
+        }
+
+    def _send(self, message):
+        try:
+            self._conn.send(message)
+        except (BrokenPipeError, OSError):
+            logging.exception("No se pudo enviar un mensaje al lanzador de clusters")
+
+    async def _heartbeat(self):
+        while True:
+            self._send({"op": "heartbeat", "cluster_id": self.cluster_id, "status": self.status()})
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def _on_readable(self):
+        try:
+            message = self._conn.recv()
+        except (EOFError, OSError):
+            # El lanzador murió: sin él nadie reinicia este proceso, así que se cierra
+            logging.error("Se perdió la conexión con el lanzador de clusters")
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+            asyncio.create_task(self._bot.close())
+            return
+
+        op = message.get("op")
+        if op == "event":
+            asyncio.create_task(self._run_handler(message))
+        elif op == "broadcast_result":
+            future = self._pending.pop(message["nonce"], None)
+            if future is not None and not future.done():
+                future.set_result(message["results"])
+        elif op == "shutdown":
+            asyncio.create_task(self._bot.close())
+
+    async def _run_handler(self, message):
+        try:
+            data = await self._dispatch(message["event"], message["payload"])
+        except Exception:
+            logging.exception(f"Error al atender el evento {message['event']} del cluster")
+            data = None
+        self._send({"op": "result", "nonce": message["nonce"], "cluster_id": self.cluster_id, "data": data})
+
+    async def _dispatch(self, event, payload):
+        func = self._handlers.get(event)
+        if func is None:
+            return None
+        return await func(**payload)
+
+    async def broadcast(self, event, **payload):
+        """
+        Ejecuta el evento en todos los clusters y devuelve la lista de
+        resultados, uno por cluster que respondió antes del timeout.
+        """
+        if not self.attached:
+            return [await self._dispatch(event, payload)]
+
+        nonce = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[nonce] = future
+        self._send({"op": "broadcast", "nonce": nonce, "event": event, "payload": payload})
+        try:
+            # El lanzador responde con lo recibido al cumplirse el timeout; aquí se le da un margen
+            return await asyncio.wait_for(future, self.timeout + 5)
+        finally:
+            self._pending.pop(nonce, None)
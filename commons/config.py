@@ -1,11 +1,19 @@
+import asyncio
+import logging
 import os
 from distutils.util import strtobool
 
 import discord
-import spotipy
 from discord.ext import commands
 from dotenv import load_dotenv
-from spotipy.oauth2 import SpotifyClientCredentials
+
+from commons.cluster import ClusterClient
+from commons.http_client import HttpClient
+from commons.metrics import MetricsServer, registry
+from commons.spotify_client import SpotifyClient, parse_endpoint_concurrency
+from commons.token_service import TokenService
+from commons.watchdog import LoopWatchdog
+from play_music.guild_state import GuildStateManager
 
 load_dotenv()
 
@@ -24,31 +32,226 @@ class Config(object):
     MONGODB_PASS = os.getenv("MONGODB_PASS")
     MONGODB_HOST = os.getenv("MONGODB_HOST")
     MONGODB_PORT = os.getenv("MONGODB_PORT")
+    MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 50))
+    MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+    MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", 60000))
     SPOTIPY_REDIRECT_URI = SPOTIPY_REDIRECT_URI_DEV if DEBUG else SPOTIPY_REDIRECT_URI_PROD
     FAST_API_PORT = 8002 if DEBUG else 8001
+    # Levanta FastAPI en un hilo del bot en lugar de en su propio proceso
+    FASTAPI_IN_PROCESS = bool(strtobool(os.getenv("FASTAPI_IN_PROCESS", "false")))
+    # /metrics de Prometheus servido desde el proceso del bot (0 lo desactiva). Con el
+    # lanzador de clusters cada proceso usa METRICS_PORT + CLUSTER_ID
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", 9101))
+    # Vigilante del event loop: cada cuántos segundos late, desde cuántos segundos sin
+    # latir se considera bloqueado y si el comando que bloqueó falla al terminar (pruebas)
+    LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+    LOOP_WATCHDOG_THRESHOLD = float(os.getenv("LOOP_WATCHDOG_THRESHOLD", 1.0))
+    LOOP_WATCHDOG_FAIL_FAST = bool(strtobool(os.getenv("LOOP_WATCHDOG_FAIL_FAST", "false")))
     ADMIN_ID = int(os.getenv("ADMIN_ID"))
 
+    # Sharding: con SHARD_COUNT (o SHARDED=true) el bot usa AutoShardedBot.
+    # launcher.py fija SHARD_IDS, SHARD_COUNT y CLUSTER_ID en cada proceso
+    SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+    SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+    SHARDED = bool(strtobool(os.getenv("SHARDED", "false"))) or SHARD_COUNT is not None
+    CLUSTER_ID = int(os.getenv("CLUSTER_ID", 0))
+    CLUSTER_COUNT = int(os.getenv("CLUSTER_COUNT", os.cpu_count() or 1))
+
+    # Lanzador de clusters: intervalos y timeouts en segundos
+    CLUSTER_HEARTBEAT_INTERVAL = int(os.getenv("CLUSTER_HEARTBEAT_INTERVAL", 10))
+    CLUSTER_HEARTBEAT_TIMEOUT = int(os.getenv("CLUSTER_HEARTBEAT_TIMEOUT", 60))
+    CLUSTER_STARTUP_TIMEOUT = int(os.getenv("CLUSTER_STARTUP_TIMEOUT", 300))
+    CLUSTER_IPC_TIMEOUT = int(os.getenv("CLUSTER_IPC_TIMEOUT", 30))
+
+    # Límites de concurrencia al importar playlists de Spotify
+    PLAYLIST_GUILD_CONCURRENCY = int(os.getenv("PLAYLIST_GUILD_CONCURRENCY", 4))
+    PLAYLIST_GLOBAL_CONCURRENCY = int(os.getenv("PLAYLIST_GLOBAL_CONCURRENCY", 16))
+
+    # Llamadas concurrentes por endpoint de Spotify ("default=4,playlists=8") y reintentos
+    SPOTIFY_ENDPOINT_CONCURRENCY = os.getenv("SPOTIFY_ENDPOINT_CONCURRENCY", "default=4,playlists=8")
+    SPOTIFY_MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", 3))
+
+    # Procesos de yt-dlp: cantidad, timeout por extracción (segundos) y peticiones en espera
+    YTDL_WORKERS = int(os.getenv("YTDL_WORKERS", 2))
+    YTDL_TIMEOUT = int(os.getenv("YTDL_TIMEOUT", 30))
+    YTDL_MAX_PENDING = int(os.getenv("YTDL_MAX_PENDING", 64))
+    YTDL_MAX_PENDING_PER_GUILD = int(os.getenv("YTDL_MAX_PENDING_PER_GUILD", 16))
+
+    # Segundos de margen antes de que expire la URL de audio para volver a resolverla
+    STREAM_URL_EXPIRY_MARGIN = int(os.getenv("STREAM_URL_EXPIRY_MARGIN", 300))
+
+    # Si el audio de origen ya es Opus se envía sin recodificar. Cambiar el volumen exige
+    # decodificar el audio, así que con AUDIO_PASSTHROUGH se ignora AUDIO_VOLUME y todas
+    # las canciones (recodificadas, copiadas o de la caché) suenan a volumen completo.
+    # Al cambiar esta opción conviene vaciar AUDIO_CACHE_DIR para no mezclar niveles
+    AUDIO_PASSTHROUGH = bool(strtobool(os.getenv("AUDIO_PASSTHROUGH", "false")))
+    AUDIO_VOLUME = float(os.getenv("AUDIO_VOLUME", 0.25))
+
+    # Memoria máxima (bytes) por servidor para repetir desde memoria la canción en loop
+    LOOP_REPLAY_MAX_BYTES = int(os.getenv("LOOP_REPLAY_MAX_BYTES", 16 * 1024 * 1024))
+
+    # Caché opcional en disco de canciones en Ogg/Opus (tamaño en bytes, duración en segundos)
+    AUDIO_CACHE_ENABLED = bool(strtobool(os.getenv("AUDIO_CACHE_ENABLED", "false")))
+    AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+    AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", 2 * 1024**3))
+    AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", 2))
+    AUDIO_CACHE_MAX_DURATION = int(os.getenv("AUDIO_CACHE_MAX_DURATION", 900))
+
+    # Reproducción sin pausas: segundos de anticipación y frames Opus (20 ms) en buffer
+    GAPLESS_PLAYBACK = bool(strtobool(os.getenv("GAPLESS_PLAYBACK", "true")))
+    PREBUFFER_LEAD_SECONDS = int(os.getenv("PREBUFFER_LEAD_SECONDS", 5))
+    PREBUFFER_FRAMES = int(os.getenv("PREBUFFER_FRAMES", 150))
 
-queues = {}
-voice_clients = {}
-loop_flags = {}
-loop_song = {}
-user_tokens = {}
+    # Caché de búsquedas y metadatos de YouTube (TTL en segundos)
+    RESOLUTION_CACHE_PATH = os.getenv("RESOLUTION_CACHE_PATH", "resolution_cache.sqlite3")
+    RESOLUTION_CACHE_MEMORY_SIZE = int(os.getenv("RESOLUTION_CACHE_MEMORY_SIZE", 2048))
+    RESOLUTION_CACHE_DISK_SIZE = int(os.getenv("RESOLUTION_CACHE_DISK_SIZE", 100000))
+    RESOLUTION_CACHE_QUERY_TTL = int(os.getenv("RESOLUTION_CACHE_QUERY_TTL", 7 * 86400))
+    RESOLUTION_CACHE_METADATA_TTL = int(os.getenv("RESOLUTION_CACHE_METADATA_TTL", 30 * 86400))
+
+    # Pool de conexiones HTTP compartido
+    HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+    HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 10))
+    HTTP_KEEPALIVE_TIMEOUT = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+    HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+
+    # Estado por servidor: inactividad (segundos) y presupuesto de memoria (bytes)
+    GUILD_IDLE_TIMEOUT = int(os.getenv("GUILD_IDLE_TIMEOUT", 300))
+    GUILD_STATE_TTL = int(os.getenv("GUILD_STATE_TTL", 3600))
+    GUILD_MEMORY_BUDGET = int(os.getenv("GUILD_MEMORY_BUDGET", 64 * 1024 * 1024))
+    GUILD_SWEEP_INTERVAL = int(os.getenv("GUILD_SWEEP_INTERVAL", 60))
+
+    # Tokens de Spotify de los usuarios: se renuevan TOKEN_REFRESH_MARGIN segundos antes de
+    # vencer y se descartan de memoria tras USER_TOKEN_TTL segundos sin usarse
+    USER_TOKEN_TTL = int(os.getenv("USER_TOKEN_TTL", 3600))
+    TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", 300))
+    TOKEN_REFRESH_INTERVAL = int(os.getenv("TOKEN_REFRESH_INTERVAL", 60))
+
+    # Dataset de preferencias columnar; DATASET_CSV es el archivo anterior, que se migra una vez
+    DATASET_DIR = os.getenv("DATASET_DIR", "dataset")
+    DATASET_CSV = os.getenv("DATASET_CSV", "dataset.csv")
+
+    # Artefactos versionados del motor de recomendaciones (escalador, índice y matriz)
+    ML_MODEL_DIR = os.getenv("ML_MODEL_DIR", "models")
+    ML_N_NEIGHBORS = int(os.getenv("ML_N_NEIGHBORS", 5))
+    # Segundos entre guardados del motor: los logins de ese intervalo van en un solo artefacto
+    ML_SAVE_INTERVAL = int(os.getenv("ML_SAVE_INTERVAL", 300))
+    # Índice de vecinos: brute (exacto), tree (KDTree, exacto) o ivf (aproximado). En ivf,
+    # ML_IVF_PROBES es la perilla entre recall y latencia; ML_IVF_LISTS=0 usa sqrt(filas)
+    ML_INDEX_BACKEND = os.getenv("ML_INDEX_BACKEND", "brute")
+    ML_TREE_LEAF_SIZE = int(os.getenv("ML_TREE_LEAF_SIZE", 40))
+    ML_IVF_LISTS = int(os.getenv("ML_IVF_LISTS", 0))
+    ML_IVF_PROBES = int(os.getenv("ML_IVF_PROBES", 8))
+
+    # Timeout (segundos) para servicios locales (FastAPI, ngrok) y TTL de la consulta a ngrok
+    LOCAL_HTTP_TIMEOUT = float(os.getenv("LOCAL_HTTP_TIMEOUT", 3))
+    NGROK_TUNNELS_TTL = int(os.getenv("NGROK_TUNNELS_TTL", 30))
+
+
+# Cliente HTTP compartido; se abre en setup_hook y se cierra al apagar el bot
+http_client = HttpClient(
+    limit=Config.HTTP_POOL_LIMIT,
+    limit_per_host=Config.HTTP_POOL_LIMIT_PER_HOST,
+    keepalive_timeout=Config.HTTP_KEEPALIVE_TIMEOUT,
+    dns_cache_ttl=Config.HTTP_DNS_CACHE_TTL,
+)
+
+
+# Todo el estado por servidor (colas, clientes de voz, loop) vive aquí
+guild_states = GuildStateManager(
+    idle_timeout=Config.GUILD_IDLE_TIMEOUT,
+    state_ttl=Config.GUILD_STATE_TTL,
+    memory_budget=Config.GUILD_MEMORY_BUDGET,
+    sweep_interval=Config.GUILD_SWEEP_INTERVAL,
+)
+
+
+# Canal con el lanzador de clusters; sin lanzador los eventos son solo locales
+cluster = ClusterClient(heartbeat_interval=Config.CLUSTER_HEARTBEAT_INTERVAL, timeout=Config.CLUSTER_IPC_TIMEOUT)
+
+
+# /metrics del proceso del bot; se abre en setup_hook
+metrics_server = MetricsServer(
+    registry,
+    host=Config.METRICS_HOST,
+    port=Config.METRICS_PORT + Config.CLUSTER_ID if Config.METRICS_PORT else 0,
+)
+
+
+# Mide el retraso del event loop y detecta llamadas bloqueantes
+loop_watchdog = LoopWatchdog(
+    interval=Config.LOOP_LAG_INTERVAL,
+    threshold=Config.LOOP_WATCHDOG_THRESHOLD,
+    fail_fast=Config.LOOP_WATCHDOG_FAIL_FAST,
+)
+
+
+class BotDiscord(commands.AutoShardedBot if Config.SHARDED else commands.Bot):
+    async def setup_hook(self):
+        # Import local: commons.db depende de este módulo
+        from commons.db import MongoDB
+        from play_music.bot_music import extractor_pool
+
+        await http_client.start()
+        guild_states.start()
+        token_service.start()
+        extractor_pool.start()
+        loop_watchdog.register_commands(self.walk_commands())
+        loop_watchdog.start()
+        cluster.start(self)
+        try:
+            await metrics_server.start()
+        except OSError:
+            logging.exception(f"No se pudo abrir /metrics en el puerto {metrics_server.port}")
+        try:
+            await MongoDB.ensure_indexes()
+        except Exception:
+            logging.exception("No se pudieron crear los índices de MongoDB")
+
+    async def close(self):
+        from commons.db import MongoDB
+        from play_music.bot_music import extractor_pool, resolution_cache
+
+        guild_states.stop()
+        token_service.stop()
+        cluster.stop()
+        loop_watchdog.stop()
+        await super().close()
+        await metrics_server.stop()
+        await extractor_pool.close()
+        # Escribe en SQLite lo que quede pendiente en la caché de resoluciones
+        await asyncio.to_thread(resolution_cache.close)
+        await http_client.close()
+        MongoDB.close_all()
 
 
 # Configuración de intents
 intents = discord.Intents.default()
 intents.message_content = True
-bot_discord = commands.Bot(command_prefix=Config.COMMAND_PREFIX, intents=intents)
+shard_options = {}
+if Config.SHARDED:
+    shard_options = {"shard_count": Config.SHARD_COUNT, "shard_ids": Config.SHARD_IDS}
+bot_discord = BotDiscord(command_prefix=Config.COMMAND_PREFIX, intents=intents, **shard_options)
 
 # Credenciales de Spotify desde variables de entorno
 if not Config.SPOTIPY_CLIENT_ID or not Config.SPOTIPY_CLIENT_SECRET:
     raise ValueError("Las variables de entorno SPOTIPY_CLIENT_ID y SPOTIPY_CLIENT_SECRET deben estar configuradas.")
 
-client_spotipy = spotipy.Spotify(
-    auth_manager=SpotifyClientCredentials(
-        client_id=Config.SPOTIPY_CLIENT_ID, client_secret=Config.SPOTIPY_CLIENT_SECRET
-    )
+spotify_client = SpotifyClient(
+    http_client,
+    Config.SPOTIPY_CLIENT_ID,
+    Config.SPOTIPY_CLIENT_SECRET,
+    endpoint_concurrency=parse_endpoint_concurrency(Config.SPOTIFY_ENDPOINT_CONCURRENCY),
+    max_retries=Config.SPOTIFY_MAX_RETRIES,
+)
+
+# Tokens OAuth de los usuarios, en memoria y renovados antes de vencer
+token_service = TokenService(
+    spotify_client,
+    refresh_margin=Config.TOKEN_REFRESH_MARGIN,
+    check_interval=Config.TOKEN_REFRESH_INTERVAL,
+    idle_ttl=Config.USER_TOKEN_TTL,
 )
 
 if not Config.TOKEN_DISCORD:
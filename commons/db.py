@@ -1,33 +1,80 @@
+import asyncio
+
 import motor.motor_asyncio
+import pymongo
+from pymongo import ReturnDocument, UpdateOne
 
 from commons.config import Config as config
 
+# Índices que deben existir por base de datos: colección -> [(llaves, opciones)]
+INDEXES = {
+    "bot_spotipy": {
+        "users": [([("user_id", pymongo.ASCENDING)], {"unique": True})],
+        "dataset": [([("user_id", pymongo.ASCENDING), ("track_id", pymongo.ASCENDING)], {})],
+    },
+}
+
 
 class MongoDB:
+    # Un cliente (con su pool de conexiones) por event loop, compartido por todas las instancias
+    _clients = {}
+
     def __init__(self, db):
         try:
-            mongo_uri = (
-                f"mongodb://{config.MONGODB_USER}:{config.MONGODB_PASS}@{config.MONGODB_HOST}:{config.MONGODB_PORT}/"
-            )
-            self.client = motor.motor_asyncio.AsyncIOMotorClient(mongo_uri)
+            self.client = self.get_client()
             self.db = self.client[db]
 
         except Exception as e:
             print(f"Error al conectar a MongoDB: {e}")
             raise e
 
+    @classmethod
+    def get_client(cls):
+        loop = asyncio.get_event_loop()
+        client = cls._clients.get(loop)
+        if client is None:
+            mongo_uri = (
+                f"mongodb://{config.MONGODB_USER}:{config.MONGODB_PASS}@{config.MONGODB_HOST}:{config.MONGODB_PORT}/"
+            )
+            client = motor.motor_asyncio.AsyncIOMotorClient(
+                mongo_uri,
+                maxPoolSize=config.MONGODB_MAX_POOL_SIZE,
+                minPoolSize=config.MONGODB_MIN_POOL_SIZE,
+                maxIdleTimeMS=config.MONGODB_MAX_IDLE_TIME_MS,
+                io_loop=loop,
+            )
+            cls._clients[loop] = client
+        return client
+
+    @classmethod
+    async def ensure_indexes(cls):
+        """
+        Crea (si no existen) los índices declarados en INDEXES.
+        """
+        client = cls.get_client()
+        for db_name, collections in INDEXES.items():
+            for collection, indexes in collections.items():
+                for keys, options in indexes:
+                    await client[db_name][collection].create_index(keys, **options)
+
+    @classmethod
+    def close_all(cls):
+        for client in cls._clients.values():
+            client.close()
+        cls._clients.clear()
+
     async def insert_document(self, document, collection, ttl=False, upsert=False, query={}):
         try:
             self.collection = self.db[collection]
             if upsert:
-                result = await self.collection.update_one(query, {"$set": document}, upsert=True)
-                inserted_document = await self.collection.find_one({"_id": result.upserted_id})
-                return inserted_document
-            result = await self.collection.insert_one(document)
+                return await self.collection.find_one_and_update(
+                    query, {"$set": document}, upsert=True, return_document=ReturnDocument.AFTER
+                )
+            # insert_one agrega el _id al documento, no hace falta volver a leerlo
+            await self.collection.insert_one(document)
             if ttl:
                 await self.collection.create_index("date_expire", expireAfterSeconds=0)
-            inserted_document = await self.collection.find_one({"_id": result.inserted_id})
-            return inserted_document
+            return document
 
         except Exception as e:
             print(f"Error al insertar documento: {e}")
@@ -44,10 +91,40 @@ class MongoDB:
         return [{**doc, "_id": str(doc.get("_id"))} async for doc in documents]
 
     async def update_document(self, collection, query, update, **params):
+        return await self.find_one_and_update(collection, query, update, **params)
+
+    async def find_one_and_update(self, collection, query, update, **params):
+        """
+        Actualiza y devuelve el documento ya actualizado en una sola ida y vuelta.
+        """
         self.collection = self.db[collection]
-        result = await self.collection.update_one(query, update, **params)
-        document = await self.find_document(query=query, collection=collection)
-        return document
+        return await self.collection.find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER, **params
+        )
+
+    async def insert_many(self, documents, collection, ordered=False):
+        self.collection = self.db[collection]
+        if not documents:
+            return []
+        result = await self.collection.insert_many(documents, ordered=ordered)
+        return result.inserted_ids
+
+    async def bulk_write(self, operations, collection, ordered=False):
+        self.collection = self.db[collection]
+        if not operations:
+            return None
+        return await self.collection.bulk_write(operations, ordered=ordered)
+
+    async def bulk_upsert(self, documents, collection, keys):
+        """
+        Inserta o actualiza varios documentos en una sola llamada; es idempotente
+        sobre las llaves indicadas, ej. keys=("user_id", "track_id").
+        """
+        operations = [
+            UpdateOne({key: document[key] for key in keys}, {"$set": document}, upsert=True)
+            for document in documents
+        ]
+        return await self.bulk_write(operations, collection)
 
     async def delete_document(self, collection, query):
         self.collection = self.db[collection]
@@ -60,6 +137,10 @@ class MongoDB:
         return count
 
     async def close_connection(self):
+        # El cliente es compartido: se cierra el pool del event loop actual
+        for loop, client in list(self._clients.items()):
+            if client is self.client:
+                del self._clients[loop]
         self.client.close()
 
     async def delete_all_documents(self, collection: str):
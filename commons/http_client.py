@@ -0,0 +1,48 @@
+import aiohttp
+
+
+class HttpClient:
+    """
+    Sesión aiohttp compartida durante toda la vida del bot, con conexiones
+    persistentes (keep-alive), límite por host y caché de DNS.
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, keepalive_timeout=30, dns_cache_ttl=300, timeout=30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self._session = None
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            raise RuntimeError("El cliente HTTP no está iniciado.")
+        return self._session
+
+    async def get_json(self, url, timeout=None, **params):
+        # timeout en segundos para esta petición; por defecto el de la sesión
+        if timeout is not None:
+            params["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        async with self.session.get(url, **params) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
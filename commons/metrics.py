@@ -0,0 +1,270 @@
+"""
+Registro mínimo de métricas en formato de texto de Prometheus. Las métricas
+se actualizan desde el event loop del bot y desde los hilos de audio, y se
+leen desde el servidor de /metrics (o el hilo de FastAPI), por eso cada una
+tiene su propio lock.
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labelnames}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+
+
+class Gauge(Metric):
+    """
+    Valor instantáneo; con set_function se calcula al momento de leerlo.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                values = {(): self._function()}
+            except Exception:
+                values = {(): math.nan}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in values.items():
+            yield f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # etiquetas -> [conteos por bucket..., suma, total]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    item[index] += 1
+            item[-2] += value
+            item[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(item) for key, item in self._values.items()}
+        for key, item in values.items():
+            for index, bound in enumerate(self.buckets):
+                labels = format_labels(self.labelnames, key, [("le", format_value(bound))])
+                yield f"{self.name}_bucket{labels} {item[index]}"
+            yield f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', '+Inf')])} {item[-1]}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(item[-2])}"
+            yield f"{self.name}_count{format_labels(self.labelnames, key)} {item[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"La métrica {metric.name} ya está registrada")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+class MetricsServer:
+    """
+    Servidor HTTP mínimo que expone /metrics desde el proceso del bot, que es
+    donde viven sus métricas (FastAPI corre normalmente en otro proceso).
+    """
+
+    def __init__(self, registry, host="127.0.0.1", port=9101):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        # render lee /proc para contar procesos de FFmpeg: se hace fuera del event loop
+        body = await asyncio.to_thread(self.registry.render)
+        return web.Response(body=body.encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        if self._runner is not None or not self.port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except Exception:
+            await runner.cleanup()
+            raise
+        self._runner = runner
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+registry = Registry()
+
+command_duration = registry.histogram(
+    "bot_command_duration_seconds", "Duración de los comandos del bot.", ["command"]
+)
+command_errors = registry.counter("bot_command_errors_total", "Comandos que terminaron con error.", ["command"])
+search_duration = registry.histogram("bot_youtube_search_duration_seconds", "Duración de las búsquedas en YouTube.")
+extract_duration = registry.histogram(
+    "bot_ytdl_extract_duration_seconds", "Duración de las extracciones de yt-dlp.", buckets=DEFAULT_BUCKETS + (60,)
+)
+time_to_first_audio = registry.histogram(
+    "bot_time_to_first_audio_seconds", "Tiempo desde >p hasta el primer frame de audio enviado."
+)
+queued_songs = registry.gauge("bot_queued_songs", "Canciones en cola sumando todos los servidores.")
+max_queue_length = registry.gauge("bot_max_queue_length", "Cola más larga entre todos los servidores.")
+voice_clients = registry.gauge("bot_voice_clients", "Clientes de voz conectados.")
+ffmpeg_processes = registry.gauge("bot_ffmpeg_processes", "Procesos de FFmpeg hijos del bot.")
+executor_queue_depth = registry.gauge(
+    "bot_executor_queue_depth", "Tareas esperando en el ThreadPoolExecutor por defecto del event loop."
+)
+ytdl_pending = registry.gauge("bot_ytdl_pending", "Extracciones de yt-dlp esperando un proceso libre.")
+loop_lag = registry.gauge("bot_event_loop_lag_seconds", "Último retraso medido del event loop.")
+loop_lag_histogram = registry.histogram(
+    "bot_event_loop_lag_distribution_seconds", "Retrasos medidos del event loop.", buckets=(0.001,) + DEFAULT_BUCKETS
+)
+loop_stalls = registry.counter(
+    "bot_event_loop_stalls_total", "Bloqueos del event loop detectados, por comando en ejecución.", ["command"]
+)
+
+
+def default_executor_queue_depth(loop):
+    # asyncio no expone el executor por defecto; se lee su cola interna si existe
+    executor = getattr(loop, "_default_executor", None)
+    work_queue = getattr(executor, "_work_queue", None)
+    return work_queue.qsize() if work_queue is not None else 0
+
+
+def count_child_processes(name):
+    """
+    Cuenta los procesos hijos de este proceso con el nombre dado (solo Linux).
+    """
+    parent = os.getpid()
+    count = 0
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                stat = file.read()
+        except OSError:
+            continue
+        comm = stat[stat.index("(") + 1 : stat.rindex(")")]
+        ppid = int(stat[stat.rindex(")") + 2 :].split()[1])
+        if ppid == parent and comm == name:
+            count += 1
+    return count
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+from collections import Counter
+
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma llave: la primera hace la
+    llamada real y las demás esperan su resultado. Cancelar a uno de los que
+    esperan no cancela la llamada compartida.
+    """
+
+    def __init__(self):
+        self._calls = {}  # (tipo, llave) -> tarea en curso
+        self.calls = Counter()  # Llamadas reales, por tipo
+        self.saved = Counter()  # Llamadas evitadas al unirse a una en curso, por tipo
+
+    async def do(self, kind, key, func, *args, **kwargs):
+        call_key = (kind, key)
+        task = self._calls.get(call_key)
+        if task is None:
+            self.calls[kind] += 1
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[call_key] = task
+            task.add_done_callback(lambda done: self._finished(call_key, done))
+        else:
+            self.saved[kind] += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, call_key, task):
+        if self._calls.get(call_key) is task:
+            del self._calls[call_key]
+        # Si todos los que esperaban se cancelaron, nadie más lee la excepción
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug(f"Falló la llamada compartida {call_key}: {task.exception()!r}")
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "calls": dict(self.calls),
+            "saved": dict(self.saved),
+        }
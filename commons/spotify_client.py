@@ -0,0 +1,208 @@
+import asyncio
+import base64
+import logging
+import time
+import urllib.parse
+
+API_URL = "https://api.spotify.com/v1/"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+AUTHORIZE_URL = "https://accounts.spotify.com/authorize"
+
+
+class SpotifyError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Spotify respondió {status}: {message}")
+        self.status = status
+
+
+class RateLimiter:
+    """
+    Estado compartido por todas las llamadas: tras un 429 nadie vuelve a
+    llamar a Spotify hasta que pase el Retry-After.
+    """
+
+    def __init__(self, endpoint_concurrency):
+        self.endpoint_concurrency = endpoint_concurrency
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self._semaphores = {}
+
+    def semaphore(self, endpoint):
+        semaphore = self._semaphores.get(endpoint)
+        if semaphore is None:
+            limit = self.endpoint_concurrency.get(endpoint, self.endpoint_concurrency.get("default", 4))
+            semaphore = self._semaphores[endpoint] = asyncio.Semaphore(limit)
+        return semaphore
+
+    async def wait(self):
+        delay = self.blocked_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.blocked_until - time.monotonic()
+
+    def block(self, seconds):
+        self.throttled += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class SpotifyClient:
+    """
+    Cliente asíncrono de la API web de Spotify sobre el HttpClient compartido.
+    Cachea el token de client credentials, respeta Retry-After en los 429 y
+    limita las llamadas concurrentes por endpoint. as_user devuelve una vista
+    que llama con el token de un usuario y comparte los mismos límites.
+    """
+
+    def __init__(self, http_client, client_id, client_secret, endpoint_concurrency=None, max_retries=3):
+        self.http_client = http_client
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.max_retries = max_retries
+        self.access_token = None  # Token de usuario; None usa client credentials
+        self._limiter = RateLimiter(endpoint_concurrency or {"default": 4})
+        self._app_token = {"access_token": None, "expires_at": 0}
+        self._app_token_lock = asyncio.Lock()
+
+    def as_user(self, access_token):
+        client = object.__new__(SpotifyClient)
+        client.__dict__.update(self.__dict__)
+        client.access_token = access_token
+        return client
+
+    def _basic_auth(self):
+        credentials = f"{self.client_id}:{self.client_secret}".encode()
+        return {"Authorization": f"Basic {base64.b64encode(credentials).decode()}"}
+
+    async def _post_token(self, data):
+        async with self.http_client.session.post(TOKEN_URL, data=data, headers=self._basic_auth()) as response:
+            payload = await response.json(content_type=None)
+            if response.status != 200:
+                raise SpotifyError(response.status, payload.get("error_description") or payload.get("error"))
+        payload["expires_at"] = int(time.time()) + payload["expires_in"]
+        return payload
+
+    async def _get_app_token(self):
+        if self._app_token["expires_at"] - time.time() > 60:
+            return self._app_token["access_token"]
+        async with self._app_token_lock:
+            if self._app_token["expires_at"] - time.time() <= 60:
+                self._app_token.update(await self._post_token({"grant_type": "client_credentials"}))
+        return self._app_token["access_token"]
+
+    async def request(self, method, path, **params):
+        # El primer segmento de la ruta identifica al endpoint: playlists, tracks, me...
+        endpoint = path.split("/", 1)[0]
+        params = {key: value for key, value in params.items() if value is not None}
+        for attempt in range(self.max_retries + 1):
+            await self._limiter.wait()
+            token = self.access_token or await self._get_app_token()
+            async with self._limiter.semaphore(endpoint):
+                await self._limiter.wait()
+                async with self.http_client.session.request(
+                    method, API_URL + path, params=params, headers={"Authorization": f"Bearer {token}"}
+                ) as response:
+                    if response.status == 429:
+                        retry_after = float(response.headers.get("Retry-After", 1))
+                        logging.warning(f"Spotify limitó las llamadas a {endpoint}; esperando {retry_after}s")
+                        self._limiter.block(retry_after)
+                        continue
+                    if response.status >= 500 and attempt < self.max_retries:
+                        await asyncio.sleep(2**attempt)
+                        continue
+                    if response.status == 401 and self.access_token is None and attempt < self.max_retries:
+                        self._app_token["expires_at"] = 0  # Token revocado o vencido antes de tiempo
+                        continue
+                    if response.status == 204:
+                        return None
+                    payload = await response.json(content_type=None)
+                    if response.status >= 400:
+                        error = payload.get("error") if isinstance(payload, dict) else None
+                        raise SpotifyError(response.status, error.get("message") if isinstance(error, dict) else error)
+                    return payload
+        raise SpotifyError(429, f"Se agotaron los reintentos para {path}")
+
+    async def get(self, path, **params):
+        return await self.request("GET", path, **params)
+
+    # Endpoints usados por el bot, con los mismos nombres que spotipy
+
+    async def playlist(self, playlist_id, fields=None):
+        return await self.get(f"playlists/{playlist_id}", fields=fields)
+
+    async def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, additional_types=("track",)):
+        return await self.get(
+            f"playlists/{playlist_id}/tracks",
+            fields=fields,
+            limit=limit,
+            offset=offset,
+            additional_types=",".join(additional_types),
+        )
+
+    async def tracks(self, track_ids):
+        return await self.get("tracks", ids=",".join(track_ids))
+
+    async def audio_features(self, track_ids):
+        return (await self.get("audio-features", ids=",".join(track_ids)))["audio_features"]
+
+    async def artists(self, artist_ids):
+        return await self.get("artists", ids=",".join(artist_ids))
+
+    async def recommendations(self, seed_tracks=(), seed_artists=(), seed_genres=(), limit=20):
+        return await self.get(
+            "recommendations",
+            seed_tracks=",".join(seed_tracks) or None,
+            seed_artists=",".join(seed_artists) or None,
+            seed_genres=",".join(seed_genres) or None,
+            limit=limit,
+        )
+
+    async def current_user_top_tracks(self, limit=20):
+        return await self.get("me/top/tracks", limit=limit)
+
+    async def current_user_top_artists(self, limit=20):
+        return await self.get("me/top/artists", limit=limit)
+
+    # OAuth de usuarios
+
+    def authorize_url(self, redirect_uri, scope=None, state=None):
+        query = {"client_id": self.client_id, "response_type": "code", "redirect_uri": redirect_uri}
+        if scope:
+            query["scope"] = scope
+        if state:
+            query["state"] = state
+        return f"{AUTHORIZE_URL}?{urllib.parse.urlencode(query)}"
+
+    async def exchange_code(self, code, redirect_uri):
+        """
+        Cambia el código del callback de OAuth por el token del usuario.
+        """
+        return await self._post_token({"grant_type": "authorization_code", "code": code, "redirect_uri": redirect_uri})
+
+    async def validate_token(self, token_info):
+        """
+        Devuelve el token del usuario, renovado si vence en menos de un minuto.
+        """
+        if token_info["expires_at"] - time.time() > 60:
+            return token_info
+        refreshed = await self._post_token(
+            {"grant_type": "refresh_token", "refresh_token": token_info["refresh_token"]}
+        )
+        # Spotify no siempre devuelve un refresh_token nuevo
+        refreshed.setdefault("refresh_token", token_info["refresh_token"])
+        return refreshed
+
+    def stats(self):
+        return {"throttled": self._limiter.throttled, "blocked_for": max(0.0, self._limiter.blocked_until - time.monotonic())}
+
+
+def parse_endpoint_concurrency(value):
+    """
+    Lee límites del tipo "default=4,playlists=8,audio-features=2".
+    """
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            endpoint, limit = item.split("=", 1)
+            limits[endpoint.strip()] = int(limit)
+    return limits
+
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+
+from commons.singleflight import SingleFlight
+from commons.spotify_client import SpotifyError
+
+
+class TokenService:
+    """
+    Tokens OAuth de Spotify de los usuarios, en memoria y leídos de la
+    colección users, donde FastAPI guarda cada login. Una tarea en segundo
+    plano los renueva antes de que venzan, así que los comandos obtienen un
+    access token válido sin esperar a la red ni a MongoDB.
+    """
+
+    def __init__(self, spotify_client, refresh_margin=300, check_interval=60, idle_ttl=3600, refresh_concurrency=4):
+        self.spotify_client = spotify_client
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self.idle_ttl = idle_ttl
+        self.refresh_concurrency = refresh_concurrency
+        self._tokens = {}  # user_id -> token_info
+        self._last_used = {}
+        self._flight = SingleFlight()
+        self._task = None
+        self.refreshes = 0
+        self.failed_refreshes = 0
+
+    def _mongo(self):
+        # Import local: commons.db depende de commons.config, que crea este servicio
+        from commons.db import MongoDB
+
+        return MongoDB("bot_spotipy")
+
+    def __len__(self):
+        return len(self._tokens)
+
+    async def get_access_token(self, user_id):
+        """
+        Devuelve un access token válido del usuario, o None si no inició sesión.
+        """
+        user_id = str(user_id)
+        self._last_used[user_id] = time.monotonic()
+        token_info = self._tokens.get(user_id)
+        if token_info is None:
+            token_info = await self._flight.do("load", user_id, self._load, user_id)
+            if token_info is None:
+                self._last_used.pop(user_id, None)
+                return None
+        if token_info["expires_at"] - time.time() <= 0:
+            # La renovación en segundo plano no llegó a tiempo (o falló)
+            token_info = await self._flight.do("refresh", user_id, self._refresh, user_id)
+            if token_info is None:
+                return None
+        return token_info["access_token"]
+
+    async def _load(self, user_id):
+        user = await self._mongo().find_document({"user_id": user_id}, "users")
+        if not user or not user.get("token_info"):
+            return None
+        self._tokens[user_id] = user["token_info"]
+        return user["token_info"]
+
+    def _forget(self, user_id):
+        self._tokens.pop(user_id, None)
+        self._last_used.pop(user_id, None)
+
+    async def _refresh(self, user_id):
+        # MongoDB es la fuente de verdad: FastAPI guarda ahí los logins nuevos y otros
+        # clusters sus renovaciones, así que se relee antes de renovar
+        token_info = await self._load(user_id)
+        if token_info is None:
+            self._forget(user_id)
+            return None
+        if token_info["expires_at"] - time.time() > self.refresh_margin:
+            # Otro proceso ya lo renovó, o es un login nuevo
+            return token_info
+        try:
+            # expires_at=0 fuerza la renovación aunque falte más que el margen de validate_token
+            refreshed = await self.spotify_client.validate_token(dict(token_info, expires_at=0))
+        except SpotifyError as e:
+            self.failed_refreshes += 1
+            if e.status in (400, 401):
+                # invalid_grant: permiso revocado; el usuario tendrá que volver a usar >login.
+                # Un 429 o un 5xx no dicen nada del permiso y el token se conserva
+                logging.warning(f"No se pudo renovar el token del usuario {user_id}: {e}")
+                self._forget(user_id)
+                return None
+            raise
+        self.refreshes += 1
+        # Solo se escribe si el documento sigue teniendo el mismo permiso: si entretanto
+        # hubo un login nuevo, gana ese y no el token renovado del permiso anterior
+        written = await self._mongo().update_document(
+            "users",
+            {"user_id": user_id, "token_info.refresh_token": token_info["refresh_token"]},
+            {"$set": {"token_info": refreshed}},
+        )
+        if written is None:
+            return await self._load(user_id)
+        self._tokens[user_id] = refreshed
+        return refreshed
+
+    async def refresh_expiring(self):
+        now = time.time()
+        monotonic_now = time.monotonic()
+        for user_id, last_used in list(self._last_used.items()):
+            if monotonic_now - last_used >= self.idle_ttl:
+                self._tokens.pop(user_id, None)
+                del self._last_used[user_id]
+
+        expiring = [
+            user_id
+            for user_id, token_info in self._tokens.items()
+            if token_info["expires_at"] - now <= self.refresh_margin
+        ]
+        semaphore = asyncio.Semaphore(self.refresh_concurrency)
+
+        async def refresh(user_id):
+            async with semaphore:
+                await self._flight.do("refresh", user_id, self._refresh, user_id)
+
+        results = await asyncio.gather(*(refresh(user_id) for user_id in expiring), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"Error al renovar un token de Spotify: {result!r}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.refresh_expiring()
+            except Exception:
+                logging.exception("Error al renovar los tokens de Spotify")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"tokens": len(self._tokens), "refreshes": self.refreshes, "failed_refreshes": self.failed_refreshes}
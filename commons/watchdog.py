@@ -0,0 +1,137 @@
+"""
+Vigilante del event loop. Una tarea del loop marca un latido cada
+interval segundos y mide el retraso con que despierta. Un hilo aparte
+revisa los latidos: si el loop lleva más de threshold segundos sin
+latir, hay una llamada bloqueante en curso. En ese caso toma el stack del
+hilo del loop y busca en él el comando del bot que la está ejecutando.
+
+En modo fail_fast (pensado para DEBUG y pruebas) cada bloqueo queda
+pendiente hasta que alguien en el loop llama a check, que lanza
+BlockingCallError: el bot lo hace al terminar cada comando, y una prueba
+puede hacerlo al final. La excepción nunca se inyecta en el hilo del
+loop, porque caería en cualquier punto de asyncio o discord.py.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from commons import metrics
+
+
+class BlockingCallError(RuntimeError):
+    pass
+
+
+class LoopWatchdog:
+    def __init__(self, interval=0.5, threshold=1.0, fail_fast=False, history=20):
+        self.interval = interval
+        self.threshold = threshold
+        self.fail_fast = fail_fast
+        self.stalls = Counter()  # comando (o "desconocido") -> bloqueos detectados
+        self.recent = deque(maxlen=history)  # (inicio, comando, stack) de los últimos bloqueos
+        self._unchecked = deque(maxlen=history)  # Bloqueos que check todavía no reportó (fail_fast)
+        self.max_lag = 0.0
+        self._commands = {}  # code object del callback -> nombre del comando
+        self._loop = None
+        self._loop_thread_id = None
+        self._last_beat = 0.0
+        self._reported_beat = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def register_commands(self, commands):
+        """
+        Guarda el code object de cada comando para reconocerlo en un stack.
+        """
+        for command in commands:
+            self._commands[command.callback.__code__] = command.qualified_name
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        if self.fail_fast:
+            # asyncio también avisa de cada callback lento
+            self._loop.set_debug(True)
+            self._loop.slow_callback_duration = self.threshold
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _beat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, lag)
+            metrics.loop_lag.set(lag)
+            metrics.loop_lag_histogram.observe(lag)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat
+            # Cada bloqueo se reporta una sola vez, aunque dure varios ciclos
+            if blocked < self.threshold + self.interval or beat == self._reported_beat:
+                continue
+            self._reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            command = self.find_command(frame)
+            stack = "".join(traceback.format_stack(frame))
+            self.stalls[command or "desconocido"] += 1
+            self.recent.append((time.time() - blocked, command, stack))
+            metrics.loop_stalls.inc(command=command or "desconocido")
+            logging.warning(
+                f"El event loop lleva {blocked:.2f}s bloqueado"
+                f"{f' por el comando {command}' if command else ''}:\n{stack}"
+            )
+            if self.fail_fast:
+                self._unchecked.append((blocked, command, stack))
+
+    def find_command(self, frame):
+        while frame is not None:
+            command = self._commands.get(frame.f_code)
+            if command is not None:
+                return command
+            frame = frame.f_back
+        return None
+
+    def check(self):
+        """
+        Lanza BlockingCallError si hubo un bloqueo desde la última llamada.
+        Se llama desde el loop, una vez que el bloqueo ya terminó.
+        """
+        if not self._unchecked:
+            return
+        blocked, command, stack = self._unchecked.popleft()
+        self._unchecked.clear()
+        raise BlockingCallError(
+            f"El event loop estuvo {blocked:.2f}s bloqueado"
+            f"{f' por el comando {command}' if command else ''}:\n{stack}"
+        )
+
+    def stats(self):
+        return {
+            "stalls": dict(self.stalls),
+            "max_lag": self.max_lag,
+            "recent": list(self.recent),
+        }
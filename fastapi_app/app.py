@@ -1,25 +1,54 @@
+import logging
+
 import uvicorn
 from fastapi import FastAPI, Request
-from spotipy.oauth2 import SpotifyOAuth
+from fastapi.responses import PlainTextResponse
 
+from commons import metrics
 from commons.config import Config
 from commons.db import MongoDB
+from commons.http_client import HttpClient
+from commons.spotify_client import SpotifyClient, SpotifyError, parse_endpoint_concurrency
 from spotify_operations.recolect_preference import recolecta_preferencias
 
 app = FastAPI()
 
+# FastAPI corre en su propio event loop (otro proceso o un hilo del bot), así que
+# no puede usar la sesión HTTP del bot: tiene sus propios clientes
+api_http_client = HttpClient(limit=Config.HTTP_POOL_LIMIT, limit_per_host=Config.HTTP_POOL_LIMIT_PER_HOST)
+api_spotify_client = SpotifyClient(
+    api_http_client,
+    Config.SPOTIPY_CLIENT_ID,
+    Config.SPOTIPY_CLIENT_SECRET,
+    endpoint_concurrency=parse_endpoint_concurrency(Config.SPOTIFY_ENDPOINT_CONCURRENCY),
+    max_retries=Config.SPOTIFY_MAX_RETRIES,
+)
+
+
+@app.on_event("startup")
+async def startup():
+    await api_http_client.start()
+    try:
+        await MongoDB.ensure_indexes()
+    except Exception:
+        logging.exception("No se pudieron crear los índices de MongoDB")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await api_http_client.close()
+
 
 @app.get("/callback")
 async def callback(request: Request):
     code = request.query_params.get("code")
     user_id = request.query_params.get("state")  # Usar el ID de usuario como estado
 
-    sp_oauth = SpotifyOAuth(
-        client_id=Config.SPOTIPY_CLIENT_ID,
-        client_secret=Config.SPOTIPY_CLIENT_SECRET,
-        redirect_uri=Config.SPOTIPY_REDIRECT_URI,
-    )
-    token_info = sp_oauth.get_access_token(code, check_cache=False)
+    try:
+        token_info = await api_spotify_client.exchange_code(code, Config.SPOTIPY_REDIRECT_URI)
+    except SpotifyError:
+        logging.exception("Error al obtener el token de Spotify")
+        token_info = None
 
     if token_info:
         mongo = MongoDB("bot_spotipy")
@@ -28,11 +57,17 @@ async def callback(request: Request):
             "token_info": token_info,
         }
         await mongo.insert_document(document, "users", upsert=True, query={"user_id": user_id})
-        await recolecta_preferencias(user_id)
+        await recolecta_preferencias(user_id, api_spotify_client)
         return {"message": "Autenticación exitosa! Puedes cerrar esta ventana y regresar a Discord."}
     else:
         return {"message": "Error al obtener el token de acceso."}
 
 
+# Métricas de este proceso; las del bot las sirve su propio /metrics (METRICS_PORT)
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 def run_fastapi():
     uvicorn.run(app, host="127.0.0.1", port=Config.FAST_API_PORT)
@@ -0,0 +1,272 @@
+"""
+Lanzador de clusters: reparte los shards del bot entre varios procesos,
+vigila que cada uno siga vivo (heartbeats), reinicia los que fallan y
+reenvía entre clusters los eventos difundidos por IPC.
+
+Uso: python launcher.py
+Variables: CLUSTER_COUNT (procesos) y SHARD_COUNT (total de shards; por
+defecto el recomendado por Discord).
+"""
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+
+import aiohttp
+
+GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+
+# Con fork el hijo heredaría el estado del lanzador (event loop, sockets)
+mp_context = multiprocessing.get_context("spawn")
+
+
+def run_cluster(cluster_id, shard_ids, shard_count, conn):
+    """
+    Punto de entrada de cada proceso hijo. Las variables de entorno se fijan
+    antes de importar commons.config para que el bot arranque con sus shards.
+    """
+    os.environ["CLUSTER_ID"] = str(cluster_id)
+    os.environ["SHARD_IDS"] = ",".join(str(shard_id) for shard_id in shard_ids)
+    os.environ["SHARD_COUNT"] = str(shard_count)
+
+    from commons.config import Config, bot_discord, cluster
+
+    cluster.attach(conn, cluster_id)
+    import bot  # noqa: F401 - registra los comandos en bot_discord
+
+    bot_discord.run(Config.TOKEN_DISCORD)
+
+
+class ClusterProcess:
+    def __init__(self, cluster_id, shard_ids, shard_count):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.conn = None
+        self.started_at = 0
+        self.last_heartbeat = None
+        self.status = {}
+        self.failures = 0  # Caídas seguidas, para espaciar los reinicios
+
+    @property
+    def ready(self):
+        return bool(self.status.get("ready"))
+
+    def start(self, on_message):
+        parent_conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(
+            target=run_cluster,
+            args=(self.cluster_id, self.shard_ids, self.shard_count, child_conn),
+            name=f"cluster-{self.cluster_id}",
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.started_at = time.monotonic()
+        self.last_heartbeat = None
+        self.status = {}
+        asyncio.get_running_loop().add_reader(parent_conn.fileno(), on_message, self)
+        logging.info(f"Cluster {self.cluster_id} iniciado (pid {self.process.pid}, shards {self.shard_ids})")
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+            return True
+        except (BrokenPipeError, OSError):
+            return False
+
+    def detach(self):
+        if self.conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        self.conn = None
+
+    async def stop(self, timeout=10):
+        if self.process is None:
+            return
+        self.send({"op": "shutdown"})
+        await asyncio.to_thread(self.process.join, timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            await asyncio.to_thread(self.process.join, timeout)
+        if self.process.is_alive():
+            self.process.kill()
+        self.detach()
+
+
+class ClusterLauncher:
+    def __init__(
+        self, cluster_count, shard_count, heartbeat_interval=10, heartbeat_timeout=60, startup_timeout=300, ipc_timeout=30
+    ):
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.startup_timeout = startup_timeout
+        self.ipc_timeout = ipc_timeout
+        cluster_count = max(1, min(cluster_count, shard_count))
+        per_cluster = math.ceil(shard_count / cluster_count)
+        self.clusters = [
+            ClusterProcess(cluster_id, list(range(start, min(start + per_cluster, shard_count))), shard_count)
+            for cluster_id, start in enumerate(range(0, shard_count, per_cluster))
+        ]
+        self._broadcasts = {}  # nonce -> (cluster de origen, resultados, ids pendientes)
+        self._stopping = asyncio.Event()
+        self._restarting = {}  # cluster_id -> tarea de reinicio en curso
+        self._start_lock = None  # Un cluster identifica sus shards a la vez
+        self.restarts = 0
+
+    def _on_message(self, cluster):
+        try:
+            message = cluster.conn.recv()
+        except (EOFError, OSError):
+            # El proceso terminó; el chequeo de salud se encarga de reiniciarlo
+            cluster.detach()
+            return
+
+        op = message.get("op")
+        if op == "heartbeat":
+            cluster.last_heartbeat = time.monotonic()
+            cluster.status = message["status"]
+            if cluster.ready:
+                cluster.failures = 0
+        elif op == "broadcast":
+            self._start_broadcast(cluster, message)
+        elif op == "result":
+            self._collect_result(message)
+
+    def _start_broadcast(self, origin, message):
+        nonce = message["nonce"]
+        event = {"op": "event", "nonce": nonce, "event": message["event"], "payload": message["payload"]}
+        waiting = {cluster.cluster_id for cluster in self.clusters if cluster.conn is not None and cluster.send(event)}
+        self._broadcasts[nonce] = (origin, [], waiting)
+        if not waiting:
+            self._finish_broadcast(nonce)
+        else:
+            asyncio.get_running_loop().call_later(self.ipc_timeout, self._finish_broadcast, nonce)
+
+    def _collect_result(self, message):
+        item = self._broadcasts.get(message["nonce"])
+        if item is None:
+            return
+        _, results, waiting = item
+        results.append(message["data"])
+        waiting.discard(message["cluster_id"])
+        if not waiting:
+            self._finish_broadcast(message["nonce"])
+
+    def _finish_broadcast(self, nonce):
+        item = self._broadcasts.pop(nonce, None)
+        if item is None:
+            return
+        origin, results, waiting = item
+        if waiting:
+            logging.warning(f"Clusters sin responder a la difusión {nonce}: {sorted(waiting)}")
+        if origin.conn is not None:
+            origin.send({"op": "broadcast_result", "nonce": nonce, "results": results})
+
+    async def _start_cluster(self, cluster):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        # Se espera a que el cluster identifique sus shards antes de lanzar el
+        # siguiente (también entre reinicios simultáneos), para no superar el
+        # límite de IDENTIFY de Discord
+        async with self._start_lock:
+            if self._stopping.is_set():
+                return
+            cluster.start(self._on_message)
+            deadline = time.monotonic() + self.startup_timeout
+            while not cluster.ready and cluster.process.is_alive() and time.monotonic() < deadline:
+                if self._stopping.is_set():
+                    return
+                await asyncio.sleep(1)
+
+    async def _restart(self, cluster, reason):
+        logging.error(f"Reiniciando el cluster {cluster.cluster_id}: {reason}")
+        await cluster.stop()
+        cluster.failures += 1
+        self.restarts += 1
+        delay = min(2 ** (cluster.failures - 1), 60)
+        await asyncio.sleep(delay)
+        if not self._stopping.is_set():
+            await self._start_cluster(cluster)
+
+    def _schedule_restart(self, cluster, reason):
+        # Cada reinicio corre en su propia tarea: uno lento no frena el chequeo de los demás
+        task = asyncio.create_task(self._restart(cluster, reason))
+        self._restarting[cluster.cluster_id] = task
+        task.add_done_callback(lambda _: self._restarting.pop(cluster.cluster_id, None))
+
+    async def _check_health(self):
+        now = time.monotonic()
+        for cluster in self.clusters:
+            if self._stopping.is_set():
+                return
+            if cluster.cluster_id in self._restarting:
+                continue
+            if not cluster.process.is_alive():
+                self._schedule_restart(cluster, f"el proceso terminó con código {cluster.process.exitcode}")
+            elif cluster.last_heartbeat is None:
+                if now - cluster.started_at > self.startup_timeout:
+                    self._schedule_restart(cluster, "no envió heartbeats al arrancar")
+            elif now - cluster.last_heartbeat > self.heartbeat_timeout:
+                self._schedule_restart(cluster, f"sin heartbeat hace {now - cluster.last_heartbeat:.0f}s")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        for cluster in self.clusters:
+            if self._stopping.is_set():
+                break
+            await self._start_cluster(cluster)
+
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.heartbeat_interval)
+            except asyncio.TimeoutError:
+                await self._check_health()
+
+        logging.info("Deteniendo los clusters")
+        for task in list(self._restarting.values()):
+            task.cancel()
+        await asyncio.gather(*self._restarting.values(), return_exceptions=True)
+        await asyncio.gather(*(cluster.stop() for cluster in self.clusters if cluster.process is not None))
+
+
+async def recommended_shard_count(token):
+    headers = {"Authorization": f"Bot {token}"}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_BOT_URL, headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return data["shards"]
+
+
+async def main():
+    from commons.config import Config
+
+    shard_count = Config.SHARD_COUNT or await recommended_shard_count(Config.TOKEN_DISCORD)
+    launcher = ClusterLauncher(
+        cluster_count=Config.CLUSTER_COUNT,
+        shard_count=shard_count,
+        heartbeat_interval=Config.CLUSTER_HEARTBEAT_INTERVAL,
+        heartbeat_timeout=Config.CLUSTER_HEARTBEAT_TIMEOUT,
+        startup_timeout=Config.CLUSTER_STARTUP_TIMEOUT,
+        ipc_timeout=Config.CLUSTER_IPC_TIMEOUT,
+    )
+    logging.info(f"{shard_count} shards repartidos en {len(launcher.clusters)} clusters")
+    await launcher.run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s: %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,309 @@
+"""
+Dataset de preferencias en formato columnar. Cada columna es un archivo
+binario de NumPy (user_code y track_code int32, una float32 por
+característica) que se lee con memmap, así que leer solo energy y tempo no
+toca el resto. Los user_id y track_id se guardan una sola vez en
+diccionarios (users.jsonl, tracks.jsonl) y las columnas guardan su código.
+
+upsert reemplaza la fila de cada par (user_id, track_id) en su lugar o la
+agrega al final. meta.json tiene el número de filas y de entradas de cada
+diccionario, y se escribe al final de cada upsert: lo que quede más allá de
+esos conteos (un upsert interrumpido) se ignora y se trunca en el siguiente.
+
+Cada upsert incrementa la versión del store y la columna row_version guarda
+la versión que escribió cada fila por última vez, así que read(since=v)
+devuelve tanto las filas agregadas como las actualizadas después de v.
+
+Uso para migrar el CSV anterior: python -m machine_learning.dataset_store dataset.csv dataset
+"""
+
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se protege dentro del proceso
+    fcntl = None
+
+FORMAT = 1
+CODE_DTYPE = np.int32
+FEATURE_DTYPE = np.float32
+VERSION_DTYPE = np.int64
+
+
+class DatasetStore:
+    def __init__(self, directory, columns):
+        self.directory = directory
+        self.columns = tuple(columns)
+        self._rows = 0
+        self.version = 0
+        self._users = []  # código -> user_id
+        self._tracks = []  # código -> track_id
+        self._user_codes = {}
+        self._track_codes = {}
+        self._pairs = {}  # (user_code, track_code) -> fila
+        self._dictionary_bytes = {"users": 0, "tracks": 0}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self.refresh()
+        return self._rows
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _column_path(self, column):
+        return self._path(f"{column}.bin")
+
+    def _dtype(self, column):
+        if column == "row_version":
+            return VERSION_DTYPE
+        return CODE_DTYPE if column in ("user_code", "track_code") else FEATURE_DTYPE
+
+    def _read_meta(self):
+        try:
+            with open(self._path("meta.json")) as file:
+                meta = json.load(file)
+        except FileNotFoundError:
+            return {"format": FORMAT, "rows": 0, "columns": self.columns, "users": [0, 0], "tracks": [0, 0]}
+        if meta["format"] != FORMAT or tuple(meta["columns"]) != self.columns:
+            raise ValueError(f"{self.directory} tiene otro formato o columnas: {meta['columns']}")
+        return meta
+
+    def _write_meta(self):
+        meta = {
+            "format": FORMAT,
+            "rows": self._rows,
+            "version": self.version,
+            "columns": self.columns,
+            "users": [len(self._users), self._dictionary_bytes["users"]],
+            "tracks": [len(self._tracks), self._dictionary_bytes["tracks"]],
+        }
+        tmp_file = self._path(f".meta-{os.getpid()}")
+        with open(tmp_file, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp_file, self._path("meta.json"))
+
+    def _refresh(self):
+        # Incorpora lo que otro proceso haya agregado desde la última lectura
+        meta = self._read_meta()
+        for name, values, codes in (("users", self._users, self._user_codes), ("tracks", self._tracks, self._track_codes)):
+            count, size = meta[name]
+            if count <= len(values):
+                continue
+            with open(self._path(f"{name}.jsonl"), "rb") as file:
+                file.seek(self._dictionary_bytes[name])
+                lines = file.read(size - self._dictionary_bytes[name]).splitlines()
+            for line in lines[: count - len(values)]:
+                value = json.loads(line)
+                codes[value] = len(values)
+                values.append(value)
+            self._dictionary_bytes[name] = size
+        if meta["rows"] > self._rows:
+            user_codes = self._memmap("user_code", meta["rows"])[self._rows :]
+            track_codes = self._memmap("track_code", meta["rows"])[self._rows :]
+            for row, pair in enumerate(zip(user_codes.tolist(), track_codes.tolist()), start=self._rows):
+                self._pairs[pair] = row
+            self._rows = meta["rows"]
+        # Un store anterior a row_version no tiene la clave: todas sus filas son de la versión 0
+        self.version = meta.get("version", 0)
+
+    def refresh(self):
+        """
+        Incorpora lo escrito por otros procesos y devuelve la versión del store.
+        """
+        with self._lock, self._file_lock():
+            self._refresh()
+            return self.version
+
+    def _file_lock(self):
+        return _FileLock(self._path(".lock"))
+
+    def _memmap(self, column, rows):
+        if not rows:
+            return np.empty(0, dtype=self._dtype(column))
+        if column == "row_version" and not os.path.exists(self._column_path(column)):
+            return np.zeros(rows, dtype=VERSION_DTYPE)
+        return np.memmap(self._column_path(column), dtype=self._dtype(column), mode="r", shape=(rows,))
+
+    def _encode(self, value, values, codes, pending):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+            pending.append(value)
+        return code
+
+    def _append_dictionary(self, name, pending):
+        if not pending:
+            return
+        data = "".join(json.dumps(value) + "\n" for value in pending).encode()
+        with open(self._path(f"{name}.jsonl"), "a+b") as file:
+            file.truncate(self._dictionary_bytes[name])
+            file.seek(self._dictionary_bytes[name])
+            file.write(data)
+        self._dictionary_bytes[name] += len(data)
+
+    def upsert(self, records):
+        """
+        Guarda filas con user_id, track_id y las columnas del store. Un par
+        (user_id, track_id) que ya existe se sobrescribe. Devuelve cuántas
+        filas se agregaron.
+        """
+        records = [record for record in records if all(record.get(column) is not None for column in self.columns)]
+        if not records:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, self._file_lock():
+            self._refresh()
+            self.version += 1
+            new_users, new_tracks = [], []
+            updates, appends, appended = {}, [], {}
+            for record in records:
+                pair = (
+                    self._encode(str(record["user_id"]), self._users, self._user_codes, new_users),
+                    self._encode(record["track_id"], self._tracks, self._track_codes, new_tracks),
+                )
+                values = [record[column] for column in self.columns]
+                row = self._pairs.get(pair)
+                if row is not None:
+                    updates[row] = values
+                elif pair in appended:
+                    appends[appended[pair]] = (pair, values)  # Repetido en el mismo lote: gana el último
+                else:
+                    appended[pair] = len(appends)
+                    appends.append((pair, values))
+
+            self._append_dictionary("users", new_users)
+            self._append_dictionary("tracks", new_tracks)
+            if updates:
+                rows = np.fromiter(updates, dtype=np.int64)
+                values = np.asarray(list(updates.values()), dtype=FEATURE_DTYPE)
+                for position, column in enumerate(self.columns):
+                    data = np.memmap(self._column_path(column), dtype=FEATURE_DTYPE, mode="r+", shape=(self._rows,))
+                    data[rows] = values[:, position]
+                    data.flush()
+                # La versión va después de los valores: quien la vea ya lee la fila nueva
+                self._extend_column("row_version", self._rows)
+                versions = np.memmap(self._column_path("row_version"), dtype=VERSION_DTYPE, mode="r+", shape=(self._rows,))
+                versions[rows] = self.version
+                versions.flush()
+            if appends:
+                pairs = np.asarray([pair for pair, _ in appends], dtype=CODE_DTYPE)
+                values = np.asarray([row_values for _, row_values in appends], dtype=FEATURE_DTYPE)
+                self._append_column("user_code", pairs[:, 0])
+                self._append_column("track_code", pairs[:, 1])
+                for position, column in enumerate(self.columns):
+                    self._append_column(column, values[:, position])
+                self._append_column("row_version", np.full(len(appends), self.version, dtype=VERSION_DTYPE))
+                for row, (pair, _) in enumerate(appends, start=self._rows):
+                    self._pairs[pair] = row
+                self._rows += len(appends)
+            self._write_meta()
+        return len(appends)
+
+    def _append_column(self, column, values):
+        offset = self._rows * np.dtype(self._dtype(column)).itemsize
+        with open(self._column_path(column), "a+b") as file:
+            file.truncate(offset)
+            file.seek(offset)
+            file.write(np.ascontiguousarray(values, dtype=self._dtype(column)).tobytes())
+
+    def _extend_column(self, column, rows):
+        # Un store anterior a row_version no tiene el archivo: se completa con ceros
+        size = rows * np.dtype(self._dtype(column)).itemsize
+        with open(self._column_path(column), "a+b") as file:
+            if file.seek(0, os.SEEK_END) < size:
+                file.truncate(size)
+
+    def read(self, columns=None, user_id=None, since=0):
+        """
+        Lee solo las columnas pedidas (por defecto todas las características),
+        opcionalmente de un usuario y solo las filas escritas después de la
+        versión since. Devuelve {columna: np.ndarray}.
+        """
+        self.refresh()
+        rows = self._rows
+        columns = self.columns if columns is None else tuple(columns)
+        mask = None
+        if since:
+            mask = self._memmap("row_version", rows) > since
+        if user_id is not None:
+            code = self._user_codes.get(str(user_id))
+            if code is None:
+                return {column: np.empty(0, dtype=self._dtype(column)) for column in columns}
+            user_mask = self._memmap("user_code", rows) == code
+            mask = user_mask if mask is None else mask & user_mask
+        selection = slice(None) if mask is None else np.flatnonzero(mask)
+        return {column: np.array(self._memmap(column, rows)[selection]) for column in columns}
+
+    def read_records(self, user_id=None, since=0):
+        """
+        Devuelve user_ids, track_ids (decodificados) y la matriz de características.
+        """
+        data = self.read(("user_code", "track_code", *self.columns), user_id=user_id, since=since)
+        users = np.asarray(self._users, dtype=object)
+        tracks = np.asarray(self._tracks, dtype=object)
+        matrix = np.column_stack([data[column] for column in self.columns]) if len(data["user_code"]) else None
+        return users[data["user_code"]].tolist(), tracks[data["track_code"]].tolist(), matrix
+
+
+class _FileLock:
+    """
+    Bloqueo exclusivo entre procesos (el bot y FastAPI escriben el mismo store).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None and os.path.isdir(os.path.dirname(self.path)):
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def migrate_csv(csv_path, store, chunksize=100_000):
+    """
+    Migración única desde el dataset.csv de solo-agregar: los pares repetidos
+    quedan una sola vez, con los valores de la última aparición. Al terminar
+    el CSV se renombra a .migrated para no volver a importarlo. Si no existe
+    (porque otro proceso ya lo migró) no hace nada.
+    """
+    import pandas as pd
+
+    os.makedirs(store.directory, exist_ok=True)
+    # Lock propio: upsert toma el del store en cada bloque
+    with _FileLock(os.path.join(store.directory, ".migrate.lock")):
+        if not os.path.exists(csv_path):
+            return 0
+        migrated = 0
+        # Los ids se leen como texto: un user_id de Discord no cabe en un float
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype={"user_id": str, "track_id": str}):
+            chunk = chunk.dropna(subset=["user_id", "track_id", *store.columns])
+            migrated += store.upsert(chunk.to_dict("records"))
+        os.replace(csv_path, f"{csv_path}.migrated")
+    return migrated
+
+
+def main():
+    from machine_learning.model import FEATURES
+
+    csv_path, directory = sys.argv[1:3]
+    migrated = migrate_csv(csv_path, DatasetStore(directory, FEATURES))
+    print(f"{migrated} filas únicas migradas a {directory}")
+
+
+if __name__ == "__main__":
+    main()
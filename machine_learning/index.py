@@ -0,0 +1,339 @@
+"""
+Índices de vecinos más cercanos por similitud coseno para el motor de
+recomendaciones. Todos guardan los vectores normalizados en una matriz
+float32 (fila = fila del motor), aceptan inserciones y actualizaciones
+incrementales con upsert y se persisten en un directorio con archivos .npy
+que load abre con memmap, así que un catálogo grande no se copia a memoria
+hasta que se modifica.
+
+- brute: producto punto contra todas las filas. Exacto; costo lineal.
+- tree: KDTree sobre los vectores normalizados (la distancia euclidiana
+  ordena igual que la coseno). Exacto; las filas nuevas se buscan aparte
+  hasta que son suficientes para reconstruir el árbol.
+- ivf: k-means en NumPy que reparte las filas en n_lists listas; cada
+  consulta solo revisa las n_probe listas más cercanas. n_probe es la
+  perilla entre recall y latencia.
+"""
+
+import json
+import os
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(similarities, rows, k):
+    """
+    Devuelve (distancias coseno, filas) de las k similitudes más altas, ordenadas.
+    """
+    if len(similarities) > k:
+        best = np.argpartition(-similarities, k - 1)[:k]
+    else:
+        best = np.arange(len(similarities))
+    best = best[np.argsort(-similarities[best], kind="stable")]
+    return 1.0 - similarities[best], rows[best]
+
+
+class VectorIndex:
+    backend = None
+    search_params = ()  # Parámetros que solo afectan a las consultas; cambiarlos no reconstruye el índice
+
+    def __init__(self, dim):
+        self.dim = dim
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def vectors(self):
+        return self._vectors[: self._size]
+
+    def params(self):
+        return {}
+
+    def _reserve(self, size):
+        # Un arreglo abierto con memmap es de solo lectura: se copia al modificarlo
+        if size <= self._vectors.shape[0] and self._vectors.flags.writeable:
+            return
+        capacity = max(size, 1024, self._vectors.shape[0])
+        while capacity < size:
+            capacity *= 2
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[: self._size] = self.vectors
+        self._vectors = vectors
+
+    def upsert(self, rows, vectors):
+        """
+        Escribe los vectores en las filas indicadas. Las filas nuevas deben ser
+        consecutivas a partir de len(self), como las asigna el motor.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        vectors = normalize(vectors).reshape(len(rows), self.dim)
+        # Una fila repetida en el mismo lote se guarda una sola vez, con su último vector
+        last = len(rows) - 1 - np.unique(rows[::-1], return_index=True)[1]
+        if len(last) != len(rows):
+            rows, vectors = rows[last], vectors[last]
+        size = max(self._size, int(rows.max()) + 1)
+        self._reserve(size)
+        previous_size = self._size
+        self._vectors[rows] = vectors
+        self._size = size
+        self._on_upsert(rows, vectors, previous_size)
+
+    def _on_upsert(self, rows, vectors, previous_size):
+        pass
+
+    def rebuild(self, vectors):
+        self._vectors = np.empty((0, self.dim), dtype=np.float32)
+        self._size = 0
+        self._reset()
+        self.upsert(np.arange(len(vectors)), vectors)
+
+    def _reset(self):
+        pass
+
+    def search(self, query, k, **options):
+        """
+        Devuelve (distancias coseno, filas) de los k vecinos de un vector. Las
+        opciones que el backend no usa (como n_probe fuera de ivf) se ignoran.
+        """
+        raise NotImplementedError
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), self.vectors)
+        with open(os.path.join(path, "index.json"), "w") as file:
+            json.dump({"backend": self.backend, "dim": self.dim, "size": self._size, "params": self.params()}, file)
+        self._save_state(path)
+
+    def _save_state(self, path):
+        pass
+
+    def _load_state(self, path, mmap_mode):
+        pass
+
+
+class BruteForceIndex(VectorIndex):
+    backend = "brute"
+
+    def search(self, query, k, **options):
+        if not self._size:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        similarities = self.vectors @ normalize(query)
+        return top_k(similarities, np.arange(self._size), k)
+
+
+class TreeIndex(VectorIndex):
+    backend = "tree"
+
+    def __init__(self, dim, leaf_size=40, rebuild_fraction=0.1):
+        super().__init__(dim)
+        self.leaf_size = leaf_size
+        self.rebuild_fraction = rebuild_fraction
+        self._tree = None
+        self._tree_size = 0
+        self._pending = set()  # Filas nuevas o modificadas desde que se construyó el árbol
+
+    def params(self):
+        return {"leaf_size": self.leaf_size, "rebuild_fraction": self.rebuild_fraction}
+
+    def _reset(self):
+        self._tree = None
+        self._tree_size = 0
+        self._pending = set()
+
+    def _on_upsert(self, rows, vectors, previous_size):
+        self._pending.update(rows.tolist())
+
+    def _ensure_tree(self):
+        if self._tree is None or len(self._pending) > self.rebuild_fraction * self._size:
+            self._tree = KDTree(self.vectors, leaf_size=self.leaf_size)
+            self._tree_size = self._size
+            self._pending = set()
+        return self._tree
+
+    def search(self, query, k, **options):
+        if not self._size:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        query = normalize(query)
+        tree = self._ensure_tree()
+        # Se piden de más para descartar las filas del árbol que ya cambiaron
+        neighbors = min(self._tree_size, k + len(self._pending))
+        distances, rows = tree.query(query[np.newaxis], k=neighbors)
+        rows = rows[0]
+        # En vectores unitarios, distancia coseno = distancia euclidiana² / 2
+        similarities = 1.0 - distances[0].astype(np.float32) ** 2 / 2
+        if self._pending:
+            keep = ~np.isin(rows, list(self._pending))
+            pending = np.fromiter(self._pending, dtype=np.int64)
+            rows = np.concatenate([rows[keep], pending])
+            similarities = np.concatenate([similarities[keep], self._vectors[pending] @ query])
+        return top_k(similarities, rows, k)
+
+
+class IVFIndex(VectorIndex):
+    backend = "ivf"
+    search_params = ("n_probe",)
+
+    def __init__(self, dim, n_lists=0, n_probe=8, min_train=1024, retrain_factor=4, iterations=10, seed=0):
+        super().__init__(dim)
+        self.n_lists = n_lists  # 0: raíz cuadrada del número de filas al entrenar
+        self.n_probe = n_probe
+        self.min_train = min_train
+        self.retrain_factor = retrain_factor
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._lists = []  # lista -> filas
+        self._list_arrays = {}  # lista -> np.ndarray de sus filas, se invalida al modificarla
+        self._trained_size = 0
+
+    def params(self):
+        return {
+            "n_lists": self.n_lists,
+            "n_probe": self.n_probe,
+            "min_train": self.min_train,
+            "retrain_factor": self.retrain_factor,
+            "iterations": self.iterations,
+            "seed": self.seed,
+        }
+
+    def _reset(self):
+        self.centroids = None
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._lists = []
+        self._list_arrays = {}
+        self._trained_size = 0
+
+    def _assign(self, vectors, chunk=65536):
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            labels[start : start + chunk] = np.argmax(vectors[start : start + chunk] @ self.centroids.T, axis=1)
+        return labels
+
+    def _build_lists(self):
+        assignments = self._assignments[: self._size]
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self._lists = [order[offsets[i] : offsets[i + 1]].tolist() for i in range(len(self.centroids))]
+        self._list_arrays = {}
+
+    def train(self):
+        """
+        Entrena los centroides con k-means esférico sobre una muestra y reparte todas las filas.
+        """
+        rng = np.random.default_rng(self.seed)
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(self._size))), self._size)
+        sample = self.vectors[rng.choice(self._size, size=min(self._size, n_lists * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=n_lists) == 0
+            # Una lista vacía se reinicia en un punto al azar de la muestra
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize(sums)
+        self.centroids = centroids
+        self._assignments = self._assign(self.vectors)
+        self._trained_size = self._size
+        self._build_lists()
+
+    def _on_upsert(self, rows, vectors, previous_size):
+        if self.centroids is None:
+            if self._size >= self.min_train:
+                self.train()
+            return
+        if self._size > self.retrain_factor * self._trained_size:
+            self.train()
+            return
+
+        labels = self._assign(vectors)
+        if len(self._assignments) < self._size or not self._assignments.flags.writeable:
+            assignments = np.empty(self._vectors.shape[0], dtype=np.int32)
+            assignments[:previous_size] = self._assignments[:previous_size]
+            self._assignments = assignments
+        for row, label in zip(rows.tolist(), labels.tolist()):
+            if row < previous_size:
+                old = int(self._assignments[row])
+                if old == label:
+                    continue
+                self._lists[old].remove(row)
+                self._list_arrays.pop(old, None)
+            self._assignments[row] = label
+            self._lists[label].append(row)
+            self._list_arrays.pop(label, None)
+
+    def _list_rows(self, label):
+        rows = self._list_arrays.get(label)
+        if rows is None:
+            rows = self._list_arrays[label] = np.asarray(self._lists[label], dtype=np.int64)
+        return rows
+
+    def search(self, query, k, n_probe=None, **options):
+        if not self._size:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        query = normalize(query)
+        if self.centroids is None:
+            return top_k(self.vectors @ query, np.arange(self._size), k)
+
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        order = np.argsort(-(self.centroids @ query))
+        while True:
+            candidates = np.concatenate([self._list_rows(label) for label in order[:n_probe].tolist()])
+            # Si las listas revisadas no alcanzan para k vecinos se revisan más
+            if len(candidates) >= k or n_probe >= len(order):
+                break
+            n_probe *= 2
+        return top_k(self._vectors[candidates] @ query, candidates, k)
+
+    def _save_state(self, path):
+        if self.centroids is not None:
+            np.save(os.path.join(path, "centroids.npy"), self.centroids)
+            np.save(os.path.join(path, "assignments.npy"), self._assignments[: self._size])
+        with open(os.path.join(path, "ivf.json"), "w") as file:
+            json.dump({"trained_size": self._trained_size}, file)
+
+    def _load_state(self, path, mmap_mode):
+        with open(os.path.join(path, "ivf.json")) as file:
+            self._trained_size = json.load(file)["trained_size"]
+        if os.path.exists(os.path.join(path, "centroids.npy")):
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self._assignments = np.load(os.path.join(path, "assignments.npy"), mmap_mode=mmap_mode)
+            self._build_lists()
+
+
+BACKENDS = {index.backend: index for index in (BruteForceIndex, TreeIndex, IVFIndex)}
+
+
+def make_index(backend, dim, **options):
+    try:
+        return BACKENDS[backend](dim, **options)
+    except KeyError:
+        raise ValueError(f"Índice desconocido: {backend} (opciones: {', '.join(BACKENDS)})") from None
+
+
+def load_index(path, mmap=True):
+    """
+    Abre un índice guardado con save. Con mmap los vectores se leen del disco
+    bajo demanda hasta la primera modificación.
+    """
+    with open(os.path.join(path, "index.json")) as file:
+        meta = json.load(file)
+    mmap_mode = "r" if mmap else None
+    index = make_index(meta["backend"], meta["dim"], **meta["params"])
+    index._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode)
+    index._size = meta["size"]
+    index._load_state(path, mmap_mode)
+    return index
@@ -1,7 +1,290 @@
-# from sklearn.neighbors import NearestNeighbors
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
 
-# # Entrena el modelo K-Nearest Neighbors con características de las canciones
-# knn = NearestNeighbors(n_neighbors=5, metric="cosine")
-# knn.fit(train[["danceability", "energy", "valence", "tempo", "popularity"]])
+import numpy as np
+from sklearn.preprocessing import MinMaxScaler
 
-# # Prueba el modelo con canciones en el conjunto de prueba (usualmente basado en el promedio de un usuario o de una canción específica)
+from machine_learning.index import load_index, make_index
+
+# Características de cada canción, en el orden de las columnas de la matriz
+FEATURES = ("danceability", "energy", "valence", "tempo", "popularity")
+
+# Rango de cada característica según la API de Spotify (tempo en BPM). El escalador se
+# ajusta con estos límites y no con los datos: así no depende de las primeras canciones
+# que lleguen ni hay que volver a escalar el catálogo cuando crece
+FEATURE_RANGES = {
+    "danceability": (0.0, 1.0),
+    "energy": (0.0, 1.0),
+    "valence": (0.0, 1.0),
+    "tempo": (0.0, 250.0),
+    "popularity": (0.0, 100.0),
+}
+
+# Cambia si cambia el contenido de los artefactos; los de otro formato se ignoran
+ARTIFACT_FORMAT = 4
+LATEST_FILE = "LATEST"
+
+
+class RecommendationEngine:
+    """
+    Motor de recomendaciones por vecinos más cercanos. Guarda una fila por
+    canción en una matriz float32 contigua (con capacidad de sobra para
+    agregar sin copiar todo) y un índice track_id <-> fila. El índice de
+    vecinos es intercambiable (ver machine_learning.index) y recibe cada
+    fila nueva sin reconstruirse. El escalador y el índice se guardan como
+    artefactos versionados en directory, así que al arrancar se cargan en
+    lugar de volver a ajustarlos.
+    """
+
+    def __init__(
+        self, directory, n_neighbors=5, backend="brute", index_options=None, initial_capacity=1024, keep_versions=3
+    ):
+        self.directory = directory
+        self.n_neighbors = n_neighbors
+        self.backend = backend
+        self.index_options = index_options or {}
+        self.keep_versions = keep_versions
+        self.version = 0
+        self.loaded = False
+        self.track_ids = []  # fila -> track_id
+        self.rows = {}  # track_id -> fila
+        self.user_rows = {}  # user_id -> filas de sus canciones
+        self.scaler = MinMaxScaler(clip=True).fit(np.asarray([FEATURE_RANGES[feature] for feature in FEATURES]).T)
+        self.source_version = 0  # Versión del dataset ya incorporada (para ponerse al día al cargar)
+        self.unsaved = 0  # Filas agregadas desde el último save
+        self.index = make_index(backend, len(FEATURES), **self.index_options)
+        self._raw = np.empty((initial_capacity, len(FEATURES)), dtype=np.float32)
+        self._scaled = np.empty((initial_capacity, len(FEATURES)), dtype=np.float32)
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def features(self):
+        """
+        Matriz escalada (vista sin copia) de las filas en uso.
+        """
+        return self._scaled[: self._size]
+
+    def _reserve(self, rows):
+        capacity = self._raw.shape[0]
+        if self._size + rows <= capacity:
+            return
+        while capacity < self._size + rows:
+            capacity *= 2
+        for name in ("_raw", "_scaled"):
+            grown = np.empty((capacity, len(FEATURES)), dtype=np.float32)
+            grown[: self._size] = getattr(self, name)[: self._size]
+            setattr(self, name, grown)
+
+    def add(self, records):
+        """
+        Agrega (o actualiza) canciones a partir de diccionarios con user_id,
+        track_id y las columnas de FEATURES. Devuelve cuántas filas son nuevas.
+        """
+        records = [record for record in records if all(record.get(feature) is not None for feature in FEATURES)]
+        if not records:
+            return 0
+        return self.add_arrays(
+            [record["user_id"] for record in records],
+            [record["track_id"] for record in records],
+            [[record[feature] for feature in FEATURES] for record in records],
+        )
+
+    def add_arrays(self, user_ids, track_ids, values):
+        """
+        Igual que add, con las columnas por separado (values en el orden de FEATURES).
+        """
+        values = np.asarray(values, dtype=np.float32).reshape(-1, len(FEATURES))
+        if not len(values):
+            return 0
+
+        with self._lock:
+            scaled = self.scaler.transform(values).astype(np.float32)
+            self._reserve(len(values))
+            added = 0
+            rows = []
+            for position, (user_id, track_id) in enumerate(zip(user_ids, track_ids)):
+                row = self.rows.get(track_id)
+                if row is None:
+                    row = self._size
+                    self._size += 1
+                    self.rows[track_id] = row
+                    self.track_ids.append(track_id)
+                    added += 1
+                self._raw[row] = values[position]
+                self._scaled[row] = scaled[position]
+                self.user_rows.setdefault(str(user_id), set()).add(row)
+                rows.append(row)
+            self.index.upsert(rows, self._scaled[rows])
+            self.unsaved += len(rows)
+        return added
+
+    def user_profile(self, user_id):
+        """
+        Perfil promedio (escalado) de las canciones del usuario, o None si no tiene.
+        """
+        with self._lock:
+            rows = self.user_rows.get(str(user_id))
+            if not rows:
+                return None
+            return self._scaled[sorted(rows)].mean(axis=0, keepdims=True)
+
+    def recommend(self, profile, n_recommendations=5, exclude=(), **search_options):
+        """
+        Devuelve [(track_id, similitud)] de las canciones más cercanas al perfil.
+        search_options llega al índice (por ejemplo n_probe en ivf).
+        """
+        exclude = set(exclude)
+        with self._lock:
+            if not self._size:
+                return []
+            neighbors = min(self._size, n_recommendations + len(exclude))
+            profile = np.asarray(profile, dtype=np.float32).reshape(-1)
+            distances, indices = self.index.search(profile, neighbors, **search_options)
+            track_ids = [self.track_ids[row] for row in indices.tolist()]
+        results = [
+            (track_id, 1.0 - float(distance))
+            for track_id, distance in zip(track_ids, distances)
+            if track_id not in exclude
+        ]
+        return results[:n_recommendations]
+
+    def recommend_for_user(self, user_id, n_recommendations=5, **search_options):
+        profile = self.user_profile(user_id)
+        if profile is None:
+            return []
+        with self._lock:
+            listened = {self.track_ids[row] for row in self.user_rows[str(user_id)]}
+        return self.recommend(profile, n_recommendations, exclude=listened, **search_options)
+
+    # Artefactos versionados: directory/v000001/{raw.npy, scaled.npy, ids.json, scaler.pkl, index/, meta.json}
+
+    def _version_path(self, version):
+        return os.path.join(self.directory, f"v{version:06d}")
+
+    def latest_version(self):
+        try:
+            with open(os.path.join(self.directory, LATEST_FILE)) as file:
+                return int(file.read().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def save(self):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            version = max(self.version, self.latest_version()) + 1
+            tmp_path = os.path.join(self.directory, f".tmp-{os.getpid()}-{version}")
+            os.makedirs(tmp_path)
+            np.save(os.path.join(tmp_path, "raw.npy"), self._raw[: self._size])
+            np.save(os.path.join(tmp_path, "scaled.npy"), self.features)
+            with open(os.path.join(tmp_path, "ids.json"), "w") as file:
+                json.dump(
+                    {
+                        "track_ids": self.track_ids,
+                        "user_rows": {user_id: sorted(rows) for user_id, rows in self.user_rows.items()},
+                    },
+                    file,
+                )
+            with open(os.path.join(tmp_path, "scaler.pkl"), "wb") as file:
+                pickle.dump(self.scaler, file)
+            self.index.save(os.path.join(tmp_path, "index"))
+            with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+                json.dump(
+                    {
+                        "format": ARTIFACT_FORMAT,
+                        "version": version,
+                        "rows": self._size,
+                        "source_version": self.source_version,
+                        "features": FEATURES,
+                        "backend": self.index.backend,
+                        "created_at": time.time(),
+                    },
+                    file,
+                )
+            os.replace(tmp_path, self._version_path(version))
+            self._write_latest(version)
+            self.version = version
+            self.loaded = True
+            self.unsaved = 0
+            self._prune()
+        return version
+
+    def _write_latest(self, version):
+        tmp_file = os.path.join(self.directory, f".{LATEST_FILE}-{os.getpid()}")
+        with open(tmp_file, "w") as file:
+            file.write(str(version))
+        os.replace(tmp_file, os.path.join(self.directory, LATEST_FILE))
+
+    def _prune(self):
+        versions = sorted(
+            int(name[1:]) for name in os.listdir(self.directory) if name.startswith("v") and name[1:].isdigit()
+        )
+        for version in versions[: -self.keep_versions]:
+            shutil.rmtree(self._version_path(version), ignore_errors=True)
+
+    def load(self, version=None):
+        """
+        Carga el artefacto indicado (por defecto el último). Devuelve False si
+        no existe o es de otro formato.
+        """
+        version = version or self.latest_version()
+        path = self._version_path(version)
+        try:
+            with open(os.path.join(path, "meta.json")) as file:
+                meta = json.load(file)
+        except FileNotFoundError:
+            return False
+        if meta["format"] != ARTIFACT_FORMAT or tuple(meta["features"]) != FEATURES:
+            return False
+
+        raw = np.load(os.path.join(path, "raw.npy"))
+        scaled = np.load(os.path.join(path, "scaled.npy"))
+        with open(os.path.join(path, "ids.json")) as file:
+            ids = json.load(file)
+        with open(os.path.join(path, "scaler.pkl"), "rb") as file:
+            scaler = pickle.load(file)
+        # Los vectores del índice se leen del disco con memmap hasta que se modifiquen
+        index = load_index(os.path.join(path, "index"))
+
+        with self._lock:
+            size = len(ids["track_ids"])
+            capacity = max(self._raw.shape[0], size * 2)
+            self._raw = np.empty((capacity, len(FEATURES)), dtype=np.float32)
+            self._scaled = np.empty((capacity, len(FEATURES)), dtype=np.float32)
+            self._raw[:size] = raw
+            self._scaled[:size] = scaled
+            self._size = size
+            self.track_ids = ids["track_ids"]
+            self.rows = {track_id: row for row, track_id in enumerate(self.track_ids)}
+            self.user_rows = {user_id: set(rows) for user_id, rows in ids["user_rows"].items()}
+            self.scaler = scaler
+            self.source_version = meta["source_version"]
+            self.unsaved = 0
+            self.index = index
+            build_options = {key: value for key, value in self.index_options.items() if key not in index.search_params}
+            if index.backend != self.backend or index.params() != {**index.params(), **build_options}:
+                # Cambió la configuración del índice: se reconstruye con la matriz cargada
+                self.index = make_index(self.backend, len(FEATURES), **self.index_options)
+                self.index.rebuild(self.features)
+            else:
+                for key in index.search_params:
+                    if key in self.index_options:
+                        setattr(index, key, self.index_options[key])
+            self.version = version
+            self.loaded = True
+        return True
+
+    def reload_if_stale(self):
+        """
+        Carga una versión más nueva si otro proceso guardó una.
+        """
+        if self.latest_version() > self.version:
+            return self.load()
+        return False
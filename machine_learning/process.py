@@ -1,46 +1,114 @@
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import MinMaxScaler
+import atexit
+import logging
+import threading
 
-# Carga el dataset
-df = pd.read_csv("dataset.csv")
+from commons.config import Config
+from machine_learning.dataset_store import DatasetStore, migrate_csv
+from machine_learning.model import FEATURES, RecommendationEngine
 
-# Limpia valores nulos si existen
-df.dropna(inplace=True)
+INDEX_OPTIONS = {
+    "brute": {},
+    "tree": {"leaf_size": Config.ML_TREE_LEAF_SIZE},
+    "ivf": {"n_lists": Config.ML_IVF_LISTS, "n_probe": Config.ML_IVF_PROBES},
+}
 
-# Escala características
-scaler = MinMaxScaler()
-scaled_features = scaler.fit_transform(df[["danceability", "energy", "valence", "tempo", "popularity"]])
-df_scaled = pd.DataFrame(scaled_features, columns=["danceability", "energy", "valence", "tempo", "popularity"])
+# Dataset de preferencias deduplicado por (user_id, track_id)
+dataset_store = DatasetStore(Config.DATASET_DIR, FEATURES)
 
-# Agrega el user_id y track_id de vuelta si los necesitas en el dataset
-df_scaled["user_id"] = df["user_id"]
-df_scaled["track_id"] = df["track_id"]
+# Motor compartido; se carga del último artefacto guardado, sin volver a ajustar
+engine = RecommendationEngine(
+    Config.ML_MODEL_DIR,
+    n_neighbors=Config.ML_N_NEIGHBORS,
+    backend=Config.ML_INDEX_BACKEND,
+    index_options=INDEX_OPTIONS.get(Config.ML_INDEX_BACKEND),
+)
 
-# Divide en conjunto de entrenamiento y prueba
-train, test = train_test_split(df_scaled, test_size=0.2, random_state=42)
 
+# Serializa load/agregados/guardado entre los hilos de asyncio.to_thread
+_engine_lock = threading.RLock()
+_save_timer = None
 
-from sklearn.neighbors import NearestNeighbors
 
-# Entrena el modelo K-Nearest Neighbors con características de las canciones
-knn = NearestNeighbors(n_neighbors=5, metric="cosine")
-knn.fit(train[["danceability", "energy", "valence", "tempo", "popularity"]])
+def sincroniza_motor():
+    """
+    Agrega al motor las filas del dataset escritas (agregadas o actualizadas,
+    por este proceso o por el otro) después de la versión que ya incorporó.
+    """
+    with _engine_lock:
+        # Se toma la versión antes de leer: lo que se escriba mientras tanto se vuelve a leer la próxima vez
+        version = dataset_store.refresh()
+        user_ids, track_ids, values = dataset_store.read_records(since=engine.source_version)
+        if values is not None:
+            engine.add_arrays(user_ids, track_ids, values)
+        engine.source_version = version
+
+
+def load_engine():
+    """
+    Carga el último artefacto y le agrega lo que cambió en el dataset después
+    de guardarlo. Si todavía no hay ninguno, lo construye a partir del dataset
+    y lo guarda. La primera vez importa el dataset.csv anterior, si existe.
+    """
+    with _engine_lock:
+        if engine.loaded:
+            return engine
+        migrate_csv(Config.DATASET_CSV, dataset_store)
+        loaded = engine.load()
+        sincroniza_motor()
+        if not loaded or engine.unsaved:
+            engine.save()
+    return engine
+
+
+def agrega_preferencias(dataset):
+    """
+    Guarda en el dataset las canciones recién recolectadas de un usuario y las
+    agrega al motor. El artefacto se guarda después, una vez por
+    ML_SAVE_INTERVAL, en lugar de escribirlo completo en cada login.
+    """
+    if not dataset:
+        return
+    load_engine()
+    with _engine_lock:
+        dataset_store.upsert(dataset)
+        sincroniza_motor()
+    programa_guardado()
+
+
+def programa_guardado():
+    global _save_timer
+    with _engine_lock:
+        if _save_timer is None:
+            _save_timer = threading.Timer(Config.ML_SAVE_INTERVAL, guarda_motor)
+            _save_timer.daemon = True
+            _save_timer.start()
 
-# Prueba el modelo con canciones en el conjunto de prueba (usualmente basado en el promedio de un usuario o de una canción específica)
 
+def guarda_motor():
+    """
+    Guarda el motor si tiene filas sin guardar. Lo que no llegue a guardarse
+    antes de un cierre se recupera del dataset en el siguiente load_engine.
+    """
+    global _save_timer
+    with _engine_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+            _save_timer = None
+        if engine.unsaved:
+            try:
+                engine.save()
+            except OSError:
+                logging.exception("No se pudo guardar el motor de recomendaciones")
 
-import numpy as np
 
+atexit.register(guarda_motor)
 
-def recomienda_canciones_por_perfil(user_profile, knn_model, df, n_recommendations=5):
+
+def recomienda_canciones_por_perfil(user_profile, n_recommendations=5, exclude=(), **search_options):
     """
     Genera recomendaciones basadas en el perfil promedio de un usuario.
+    search_options ajusta la consulta del índice, por ejemplo n_probe=32 en ivf.
     """
-    # Encuentra los vecinos más cercanos en base al perfil promedio
-    distances, indices = knn_model.kneighbors(user_profile, n_neighbors=n_recommendations + 1)
-
+    load_engine()
     # Obtiene las canciones recomendadas excluyendo los top_tracks
-    recommended_indices = indices[0]
-    recommended_songs = df.iloc[recommended_indices]["track_id"].values
-    return recommended_songs
+    return [track_id for track_id, _ in engine.recommend(user_profile, n_recommendations, exclude, **search_options)]
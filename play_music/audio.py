@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import discord
+
+# Duración de un frame Opus enviado a Discord
+OPUS_FRAME_SECONDS = 0.02
+# Segundos que pueden faltar a una captura para darla por completa (las duraciones
+# de YouTube vienen redondeadas y el final suele traer silencio recortado)
+CAPTURE_TOLERANCE_SECONDS = 2
+
+
+class PrebufferedSource(discord.AudioSource):
+    """
+    Envuelve una fuente Opus y la va leyendo en un hilo aparte, manteniendo
+    un buffer de frames listo para que voice_client.play arranque sin esperar
+    a FFmpeg ni a la red.
+    """
+
+    def __init__(self, source, buffer_frames=150, on_first_frame=None, capture=None):
+        self.source = source
+        self.buffer_frames = buffer_frames
+        self.on_first_frame = on_first_frame
+        self.capture = capture
+        self.frames_read = 0
+        self.ended_at = None
+        self._frames = deque()
+        self._condition = threading.Condition()
+        self._finished = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    @property
+    def elapsed(self):
+        return self.frames_read * OPUS_FRAME_SECONDS
+
+    def _fill(self):
+        try:
+            while True:
+                with self._condition:
+                    while len(self._frames) >= self.buffer_frames and not self._closed:
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                data = self.source.read()
+                if self.capture is not None:
+                    if data:
+                        self.capture.add(data)
+                    else:
+                        self.capture.finish()
+                with self._condition:
+                    if not data:
+                        return
+                    self._frames.append(data)
+                    self._condition.notify_all()
+        except Exception:
+            logging.exception("Error al leer el audio en el buffer")
+        finally:
+            capture = self.capture
+            if capture is not None and not capture.complete and not capture.discarded:
+                # Error de lectura o fuente cerrada antes del final: la captura quedó a medias
+                capture.abort()
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def wait_ready(self, timeout=None):
+        """
+        Espera a que el buffer se llene (o a que la fuente termine).
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: len(self._frames) >= self.buffer_frames or self._finished, timeout
+            )
+
+    def read(self):
+        with self._condition:
+            while not self._frames and not self._finished:
+                self._condition.wait()
+            if not self._frames:
+                if self.ended_at is None:
+                    self.ended_at = time.perf_counter()
+                return b""
+            data = self._frames.popleft()
+            self._condition.notify_all()
+
+        self.frames_read += 1
+        if self.frames_read == 1 and self.on_first_frame is not None:
+            self.on_first_frame()
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.source.cleanup()
+
+
+class FrameCapture:
+    """
+    Guarda los frames Opus de una canción mientras suena, hasta max_bytes,
+    para repetirla en modo loop sin volver a lanzar FFmpeg.
+    """
+
+    def __init__(self, song, max_bytes):
+        self.song = song
+        self.max_bytes = max_bytes
+        self.frames = []
+        self.size = 0
+        self.complete = False
+        self.overflow = False
+        self.truncated = False
+        self.failed = False
+
+    def add(self, frame):
+        if self.overflow:
+            return
+        self.size += len(frame)
+        if self.size > self.max_bytes:
+            # No cabe en el presupuesto: se descarta todo y el loop sigue usando FFmpeg
+            self.overflow = True
+            self.frames = []
+            self.size = 0
+            return
+        self.frames.append(frame)
+
+    def finish(self):
+        """
+        La fuente terminó. Solo se da por completa si dura lo que dice la
+        canción: si FFmpeg se cortó antes (por ejemplo por un error de red)
+        la captura se descarta en lugar de repetir un fragmento en el loop.
+        """
+        if self.overflow:
+            return
+        captured = len(self.frames) * OPUS_FRAME_SECONDS
+        if self.song.duration > 0 and captured >= self.song.duration - CAPTURE_TOLERANCE_SECONDS:
+            self.complete = True
+        else:
+            logging.warning(
+                f"Captura de '{self.song.title}' incompleta ({captured:.0f}s de {self.song.duration}s); se descarta"
+            )
+            self.truncated = True
+            self.frames = []
+            self.size = 0
+
+    def abort(self):
+        """
+        La fuente falló o se cerró sin llegar al final: los frames no se reusan.
+        """
+        self.failed = True
+        self.frames = []
+        self.size = 0
+
+    @property
+    def discarded(self):
+        return self.overflow or self.truncated or self.failed
+
+    @property
+    def ready(self):
+        return self.complete and not self.overflow
+
+
+class ReplaySource(discord.AudioSource):
+    """
+    Reproduce desde memoria los frames Opus ya capturados.
+    """
+
+    def __init__(self, frames):
+        self._frames = frames
+        self._position = 0
+
+    def read(self):
+        if self._position >= len(self._frames):
+            return b""
+        frame = self._frames[self._position]
+        self._position += 1
+        return frame
+
+    def is_opus(self):
+        return True
+
+
+class GapStats:
+    """
+    Pausas medidas entre el último frame de una canción y el primero de la siguiente.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+        self._lock = threading.Lock()
+
+    def record(self, gap):
+        with self._lock:
+            self.count += 1
+            self.total += gap
+            self.max = max(self.max, gap)
+            self.last = gap
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+
+gap_stats = GapStats()
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+from collections import Counter, OrderedDict
+
+import discord
+from discord.oggparse import OggStream
+
+RECONNECT_ARGS = ("-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5")
+
+
+class OggFileSource(discord.AudioSource):
+    """
+    Lee los paquetes Opus de un archivo Ogg local, sin lanzar FFmpeg.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
+
+    def read(self):
+        return next(self._packets, b"")
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class AudioCache:
+    """
+    Caché en disco de canciones ya codificadas en Ogg/Opus, por id de video.
+    Solo se descargan las que se reprodujeron al menos min_plays veces y se
+    respeta max_bytes expulsando las menos usadas recientemente. El índice
+    vive en memoria; todo acceso al disco se hace con asyncio.to_thread.
+    """
+
+    def __init__(self, directory, max_bytes, min_plays=2, max_duration=900, max_downloads=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._entries = OrderedDict()  # video_id -> tamaño, del menos al más usado
+        self._plays = Counter()
+        self._downloads = {}
+        self._download_semaphore = asyncio.Semaphore(max_downloads)
+        self._load_lock = asyncio.Lock()
+        self._loaded = False
+
+    def path(self, video_id):
+        return os.path.join(self.directory, f"{video_id}.ogg")
+
+    def _scan(self):
+        # Se ejecuta en un hilo: lista los archivos del directorio, del menos al más usado
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".ogg"):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name[: -len(".ogg")], stat.st_size))
+            elif name.endswith(".part"):
+                os.remove(path)  # Descarga interrumpida
+        return [(video_id, size) for _, video_id, size in sorted(files)]
+
+    async def _load(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            for video_id, size in await asyncio.to_thread(self._scan):
+                self._entries[video_id] = size
+                self.total_bytes += size
+            self._loaded = True
+        await self._evict()
+
+    @staticmethod
+    def _touch(path):
+        # El mtime ordena el LRU entre reinicios; False si el archivo ya no existe
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def lookup(self, video_id):
+        """
+        Devuelve la ruta del archivo si la canción está en caché.
+        """
+        await self._load()
+        size = self._entries.get(video_id)
+        if size is not None and not await asyncio.to_thread(self._touch, self.path(video_id)):
+            self._forget(video_id)
+            size = None
+        if size is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(video_id)
+        self.hits += 1
+        self.bytes_saved += size
+        return self.path(video_id)
+
+    def should_download(self, video_id, duration):
+        self._plays[video_id] += 1
+        # El contador de reproducciones no debe crecer sin límite
+        if len(self._plays) > 10000:
+            self._plays = Counter(dict(self._plays.most_common(5000)))
+        return (
+            video_id is not None
+            and self._plays[video_id] >= self.min_plays
+            and 0 < duration <= self.max_duration
+            and video_id not in self._entries
+            and video_id not in self._downloads
+        )
+
+    def schedule_download(self, video_id, song_url, codec_args):
+        task = asyncio.create_task(self._download(video_id, song_url, codec_args))
+        self._downloads[video_id] = task
+        task.add_done_callback(lambda _: self._downloads.pop(video_id, None))
+
+    async def _download(self, video_id, song_url, codec_args):
+        await self._load()
+        path = self.path(video_id)
+        partial_path = f"{path}.part"
+        async with self._download_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg",
+                "-nostdin",
+                *RECONNECT_ARGS,
+                *("-i", song_url, "-vn", "-map_metadata", "-1"),
+                *codec_args,
+                *("-f", "ogg", "-loglevel", "error", "-y", partial_path),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+            finally:
+                if process.returncode != 0:
+                    await asyncio.to_thread(self._remove_files, [partial_path])
+
+        if process.returncode != 0:
+            logging.error(f"No se pudo guardar {video_id} en la caché de audio: {stderr.decode(errors='ignore')}")
+            return
+        size = await asyncio.to_thread(self._publish, partial_path, path)
+        self._entries[video_id] = size
+        self.total_bytes += size
+        await self._evict()
+
+    @staticmethod
+    def _publish(partial_path, path):
+        os.replace(partial_path, path)
+        return os.path.getsize(path)
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, video_id):
+        self.total_bytes -= self._entries.pop(video_id, 0)
+
+    async def _evict(self):
+        # El índice se actualiza de inmediato; los archivos se borran en un hilo
+        paths = []
+        while self.total_bytes > self.max_bytes and self._entries:
+            video_id, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            paths.append(self.path(video_id))
+        if paths:
+            await asyncio.to_thread(self._remove_files, paths)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "files": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "downloads": len(self._downloads),
+        }
@@ -0,0 +1,68 @@
+"""
+Compara el costo de CPU de FFmpeg al recodificar el audio (con filtro de volumen)
+contra copiar los paquetes Opus tal cual.
+
+Uso: python -m play_music.benchmark_playback <url de YouTube o archivo> [segundos]
+"""
+
+import resource
+import subprocess
+import sys
+import time
+
+import yt_dlp
+
+# Los mismos argumentos que arma discord.FFmpegOpusAudio
+MODES = {
+    "recodificar": ["-c:a", "libopus", "-ar", "48000", "-ac", "2", "-b:a", "128k", "-filter:a", "volume=0.25"],
+    "passthrough": ["-c:a", "copy"],
+}
+
+
+def resolve_source(source):
+    if "youtube.com/" not in source and "youtu.be/" not in source:
+        return source, None
+    with yt_dlp.YoutubeDL({"format": "bestaudio[acodec=opus]/bestaudio/best", "quiet": True}) as ytdl:
+        data = ytdl.extract_info(source, download=False)
+    return data["url"], data.get("acodec")
+
+
+def run_ffmpeg(source, codec_args, seconds):
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-i", source, "-t", str(seconds), "-vn", "-map_metadata", "-1", "-f", "opus"]
+        + codec_args
+        + ["-loglevel", "error", "pipe:1"],
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    wall = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return cpu, wall
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    source, codec = resolve_source(sys.argv[1])
+    print(f"Códec de origen: {codec or 'desconocido'} - {seconds}s de audio")
+
+    results = {}
+    for mode, codec_args in MODES.items():
+        if mode == "passthrough" and codec not in (None, "opus"):
+            print(f"{mode:>12}: no aplica, el origen no es Opus")
+            continue
+        cpu, wall = run_ffmpeg(source, codec_args, seconds)
+        results[mode] = cpu
+        print(f"{mode:>12}: CPU {cpu:.2f}s ({cpu / seconds * 100:.2f}% de un núcleo en tiempo real), total {wall:.2f}s")
+
+    if results.get("passthrough"):
+        print(f"La recodificación usa {results['recodificar'] / results['passthrough']:.1f}x más CPU")
+
+
+if __name__ == "__main__":
+    main()
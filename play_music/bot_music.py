@@ -1,35 +1,95 @@
 import asyncio
+import html as html_lib
 import logging
 import re
+import time
 import urllib.parse
 import urllib.request
 
-import aiohttp
 import discord
-import yt_dlp
 from discord.ext import commands
 
 from commons.config import (
+    Config,
     bot_discord,
-    client_spotipy,
-    loop_flags,
-    loop_song,
-    queues,
-    voice_clients,
+    guild_states,
+    http_client,
+    spotify_client,
 )
+from play_music.audio import FrameCapture, PrebufferedSource, ReplaySource, gap_stats
+from play_music.audio_cache import AudioCache, OggFileSource
+from commons import metrics
+from commons.singleflight import SingleFlight
+from play_music.cache import ResolutionCache, extract_video_id, normalize_query
+from play_music.extractor import ExtractorPool
+from play_music.guild_queue import Song
 
 # Configuración de logging
 logging.basicConfig(level=logging.DEBUG)
 
 
 # Configuración de yt_dlp y ffmpeg
-yt_dl_options = {"format": "bestaudio/best","noplaylist": True,}
-ytdl = yt_dlp.YoutubeDL(yt_dl_options)
+# Se prefiere Opus para poder enviarlo a Discord sin recodificar
+yt_dl_options = {"format": "bestaudio[acodec=opus]/bestaudio/best","noplaylist": True,}
+# Las extracciones corren en procesos aparte, cada uno con su YoutubeDL
+extractor_pool = ExtractorPool(
+    yt_dl_options,
+    workers=Config.YTDL_WORKERS,
+    timeout=Config.YTDL_TIMEOUT,
+    max_pending=Config.YTDL_MAX_PENDING,
+    max_pending_per_guild=Config.YTDL_MAX_PENDING_PER_GUILD,
+)
+# Con passthrough el audio copiado no admite filtros: el resto también va a volumen
+# completo para que no cambie el nivel de una canción a otra
+audio_volume = 1.0 if Config.AUDIO_PASSTHROUGH else Config.AUDIO_VOLUME
 ffmpeg_options = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-    "options": '-vn -filter:a "volume=0.25"',
+    "options": f'-vn -filter:a "volume={audio_volume}"',
+}
+# Copia los paquetes Opus tal cual: sin decodificar ni recodificar (no admite filtros)
+ffmpeg_passthrough_options = {
+    "before_options": ffmpeg_options["before_options"],
+    "options": "-vn",
+    "codec": "copy",
 }
 
+# Caché opcional en disco de las canciones más reproducidas, ya en Ogg/Opus
+audio_cache = (
+    AudioCache(
+        Config.AUDIO_CACHE_DIR,
+        max_bytes=Config.AUDIO_CACHE_MAX_BYTES,
+        min_plays=Config.AUDIO_CACHE_MIN_PLAYS,
+        max_duration=Config.AUDIO_CACHE_MAX_DURATION,
+    )
+    if Config.AUDIO_CACHE_ENABLED
+    else None
+)
+
+# Mismos parámetros que usa FFmpegOpusAudio al recodificar, para guardar en la caché
+audio_cache_transcode_args = [
+    "-c:a", "libopus", "-b:a", "128k", "-ar", "48000", "-ac", "2", "-filter:a", f"volume={audio_volume}"
+]
+
+# Caché de búsquedas y metadatos de YouTube
+resolution_cache = ResolutionCache(
+    Config.RESOLUTION_CACHE_PATH,
+    memory_size=Config.RESOLUTION_CACHE_MEMORY_SIZE,
+    disk_size=Config.RESOLUTION_CACHE_DISK_SIZE,
+    query_ttl=Config.RESOLUTION_CACHE_QUERY_TTL,
+    metadata_ttl=Config.RESOLUTION_CACHE_METADATA_TTL,
+)
+
+# Búsquedas, extracciones y playlists idénticas en curso se resuelven una sola vez
+single_flight = SingleFlight()
+
+# Métricas que se calculan al leer /metrics
+metrics.queued_songs.set_function(lambda: sum(len(state.queue) for state in guild_states))
+metrics.max_queue_length.set_function(lambda: max((len(state.queue) for state in guild_states), default=0))
+metrics.voice_clients.set_function(lambda: len(bot_discord.voice_clients))
+metrics.ffmpeg_processes.set_function(lambda: metrics.count_child_processes("ffmpeg"))
+metrics.executor_queue_depth.set_function(lambda: metrics.default_executor_queue_depth(bot_discord.loop))
+metrics.ytdl_pending.set_function(lambda: extractor_pool.stats()["pending"])
+
 
 async def ensure_voice(ctx):
     try:
@@ -39,11 +99,16 @@ async def ensure_voice(ctx):
             await ctx.send("No tengo permisos para unirme o hablar en tu canal de voz.")
             return
 
-        if ctx.voice_client and not ctx.voice_client.is_connected():
+        state = guild_states.get(ctx.guild.id)
+        if ctx.voice_client and ctx.voice_client.is_connected():
+            state.voice_client = ctx.voice_client
+            return ctx.voice_client
+        if ctx.voice_client:
             await ctx.voice_client.disconnect(force=True)
 
         try:
             voice_client = await channel.connect()
+            state.voice_client = voice_client
             return voice_client
         except asyncio.TimeoutError as e:
             await ctx.send("❌ No se pudo conectar al canal de voz: tiempo de espera agotado.")
@@ -55,69 +120,247 @@ async def ensure_voice(ctx):
         logging.exception("Error inesperado al conectar al canal de voz")
         await ctx.send(f"Error al conectar: {e}")
 
-# Función para manejar playlists de Spotify
-async def handle_spotify_playlist(ctx, playlist_url, voice_client, is_loop):
-    guild_id = ctx.guild.id
-    try:
-        tracks_info = get_spotify_playlist_tracks(playlist_url)
-        if not tracks_info:
-            await ctx.send("No se pudieron obtener las canciones de la playlist.")
-            return
+# Semáforos que limitan cuántas canciones de playlists se resuelven a la vez
+playlist_global_semaphore = asyncio.Semaphore(Config.PLAYLIST_GLOBAL_CONCURRENCY)
 
-        tracks = tracks_info["tracks"]
-        if guild_id not in queues:
-            queues[guild_id] = []
+# Intervalo mínimo (segundos) entre actualizaciones del mensaje de progreso
+PLAYLIST_PROGRESS_INTERVAL = 2
 
-        for track_info in tracks:
-            query_string = (
-                f"{track_info['artist']} - {track_info['title']} audio oficial"
-            )
-            youtube_link = await search_youtube(query_string)
-            if youtube_link:
-                data = await ytdl_extract_info(youtube_link)
-                song_info = {
-                    "title": data["title"],
-                    "duration": data["duration"],
-                    "thumbnail": data["thumbnail"],
-                    "song_url": data["url"],
-                    "youtube_url": data["original_url"],
-                }
-                queues[guild_id].append(song_info)
-            if not voice_client.is_playing() and not voice_client.is_paused():
-                queues[guild_id].remove(song_info)
-                await play_song(ctx, song_info, voice_client, is_loop=False)
-        # Si no se está reproduciendo nada, comenzar a reproducir
-        if not voice_client.is_playing() and not voice_client.is_paused():
-            await play_next(ctx)
-
-        # Enviar un embed con la información de la playlist
-        embed = discord.Embed(
-            title=tracks_info["name"],
-            description=f"Duración {tracks_info['total_duration']} - {tracks_info['total_tracks']} canciones",
-            color=discord.Color.blue(),
-        )
-        embed.set_thumbnail(url=tracks_info.get("image"))
-        await ctx.send(
-            f"Se añadieron {tracks_info['total_tracks']} canciones de la playlist a la cola.",
-            embed=embed,
-        )
 
+# Función para manejar playlists de Spotify
+async def handle_spotify_playlist(ctx, playlist_url, voice_client, is_loop, requested_at=None):
+    state = guild_states.get(ctx.guild.id)
+    task = asyncio.create_task(import_spotify_playlist(ctx, playlist_url, voice_client, requested_at))
+    state.imports.add(task)
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        await ctx.send("Se canceló la importación de la playlist.")
     except Exception as e:
         logging.exception("Error al manejar la playlist de Spotify")
         await ctx.send(f"Ocurrió un error: {e}")
+    finally:
+        state.imports.discard(task)
+
+
+# Función para cancelar las importaciones de playlists en curso de un servidor
+def cancel_playlist_imports(guild_id):
+    state = guild_states.peek(guild_id)
+    if state is None:
+        return 0
+    tasks = list(state.imports)
+    state.imports.clear()
+    for task in tasks:
+        task.cancel()
+    return len(tasks)
+
+
+# Función para resolver una canción de la playlist a su información de YouTube
+async def resolve_playlist_track(guild_id, track_info):
+    state = guild_states.get(guild_id)
+    if state.import_semaphore is None:
+        state.import_semaphore = asyncio.Semaphore(Config.PLAYLIST_GUILD_CONCURRENCY)
+    guild_semaphore = state.import_semaphore
+    # Primero el límite del servidor, para que un servidor no acapare el global
+    async with guild_semaphore, playlist_global_semaphore:
+        query_string = f"{track_info['artist']} - {track_info['title']} audio oficial"
+        try:
+            youtube_link = await search_youtube(query_string)
+        except Exception:
+            logging.exception(f"Error al buscar la canción '{query_string}'")
+            return None
+        if not youtube_link:
+            return None
+        # Solo metadatos; la URL de audio se resuelve al momento de reproducir
+        return Song(
+            title=f"{track_info['artist']} - {track_info['title']}",
+            duration=track_info["duration"],
+            thumbnail=track_info["image"],
+            youtube_url=youtube_link,
+        )
 
 
-# Función para extraer información con yt_dlp
-async def ytdl_extract_info(url):
-    loop = asyncio.get_event_loop()
-    data = await loop.run_in_executor(
-        None, lambda: ytdl.extract_info(url, download=False)
+# Función que resuelve las canciones en paralelo y las encola en orden
+async def import_spotify_playlist(ctx, playlist_url, voice_client, requested_at=None):
+    guild_id = ctx.guild.id
+    playlist = await get_spotify_playlist(playlist_url)
+    if not playlist:
+        await ctx.send("No se pudieron obtener las canciones de la playlist.")
+        return
+
+    total = playlist["total_tracks"]
+    progress = await ctx.send(f"Importando playlist **{playlist['name']}**: 0/{total} canciones...")
+    last_update = asyncio.get_running_loop().time()
+
+    # Las canciones se empiezan a resolver apenas llega cada página de Spotify
+    resolving = asyncio.Queue()
+    started = []
+
+    async def produce():
+        try:
+            async for track_info in get_spotify_playlist_tracks(playlist):
+                task = asyncio.create_task(resolve_playlist_track(guild_id, track_info))
+                started.append(task)
+                resolving.put_nowait(task)
+        finally:
+            resolving.put_nowait(None)
+
+    producer = asyncio.create_task(produce())
+    index = 0
+    added = 0
+    try:
+        # Se esperan en orden de la playlist; las siguientes ya se resuelven en paralelo
+        while True:
+            task = await resolving.get()
+            if task is None:
+                break
+            index += 1
+            song_info = await task
+            if song_info:
+                added += 1
+                state = guild_states.get(guild_id)
+                async with state.play_lock:
+                    if not voice_client.is_playing() and not voice_client.is_paused():
+                        # La primera canción resuelta empieza a sonar de inmediato
+                        await play_song(ctx, song_info, voice_client, is_loop=False, requested_at=requested_at)
+                        requested_at = None
+                    else:
+                        state.queue.append(song_info)
+                        prefetch_next_song(guild_id)
+
+            now = asyncio.get_running_loop().time()
+            if now - last_update >= PLAYLIST_PROGRESS_INTERVAL:
+                last_update = now
+                await progress.edit(content=f"Importando playlist **{playlist['name']}**: {index}/{total} canciones...")
+        # Propaga un posible error al leer las páginas de la playlist
+        await producer
+    finally:
+        producer.cancel()
+        for task in started:
+            task.cancel()
+
+    await progress.edit(content=f"Importando playlist **{playlist['name']}**: {index}/{total} canciones.")
+
+    # Si no se está reproduciendo nada, comenzar a reproducir
+    if not voice_client.is_playing() and not voice_client.is_paused():
+        await play_next(ctx)
+
+    # Enviar un embed con la información de la playlist
+    embed = discord.Embed(
+        title=playlist["name"],
+        description=f"Duración {format_playlist_duration(playlist['total_duration_ms'])} - {playlist['loaded_tracks']} canciones",
+        color=discord.Color.blue(),
+    )
+    embed.set_thumbnail(url=playlist.get("image"))
+    await ctx.send(
+        f"Se añadieron {added} de {index} canciones de la playlist a la cola.",
+        embed=embed,
     )
+
+
+# Función para extraer información con yt_dlp
+async def ytdl_extract_info(url, guild_id=None):
+    key = extract_video_id(url) or url
+    return await single_flight.do("extract", key, extract_and_cache, url, guild_id)
+
+
+async def extract_and_cache(url, guild_id):
+    with metrics.extract_duration.time():
+        data = await extractor_pool.extract(url, guild_id)
+    resolution_cache.set_metadata(data["id"], data["title"], data["duration"], data["thumbnail"])
     return data
 
 
+# Función para obtener solo título, duración y miniatura de un video, sin resolver su audio.
+# Lee la página del video (una petición HTTP) en lugar de hacer una extracción de yt-dlp
+async def fetch_video_metadata(video_id, guild_id=None):
+    metadata = await resolution_cache.get_metadata(video_id)
+    if metadata:
+        return metadata
+    return await single_flight.do("metadata", video_id, fetch_and_cache_metadata, video_id, guild_id)
+
+
+async def fetch_and_cache_metadata(video_id, guild_id):
+    async with http_client.session.get(youtube_watch_url(video_id)) as response:
+        html = await response.text() if response.status == 200 else ""
+    title = re.search(r'<meta property="og:title" content="([^"]*)"', html)
+    length = re.search(r'"lengthSeconds":"(\d+)"', html)
+    if title is None or length is None:
+        # Página con otro formato (consentimiento, cambios de YouTube): extracción completa
+        data = await ytdl_extract_info(youtube_watch_url(video_id), guild_id)
+        return {"title": data["title"], "duration": data["duration"], "thumbnail": data["thumbnail"]}
+    metadata = {
+        "title": html_lib.unescape(title.group(1)),
+        "duration": int(length.group(1)),
+        "thumbnail": f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+    }
+    resolution_cache.set_metadata(video_id, **metadata)
+    return metadata
+
+
+# Función para construir la URL canónica de un video de YouTube
+def youtube_watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+# Función para obtener la fecha de expiración (epoch) de una URL de audio
+def stream_url_expiry(url):
+    # googlevideo la incluye como parámetro (?expire=) o en la ruta (/expire/)
+    match = re.search(r"[?&/]expire[=/](\d+)", url)
+    return int(match.group(1)) if match else None
+
+
+# Función que indica si la URL de audio de una canción sigue siendo utilizable
+def has_fresh_stream_url(song_info):
+    song_url = song_info.song_url
+    if not song_url:
+        return False
+    expire = stream_url_expiry(song_url)
+    if expire is None:
+        return True
+    # Debe seguir siendo válida durante toda la canción, más el margen
+    remaining = expire - time.time()
+    return remaining > song_info.duration + Config.STREAM_URL_EXPIRY_MARGIN
+
+
+prefetch_tasks = set()
+
+
+# Función para obtener la URL de audio de una canción justo antes de reproducirla.
+# Si el prefetch ya la está extrayendo, ytdl_extract_info espera esa misma extracción
+async def resolve_stream_url(song_info, guild_id=None):
+    if has_fresh_stream_url(song_info):
+        return song_info.song_url
+    data = await ytdl_extract_info(song_info.youtube_url, guild_id)
+    song_info.title = data["title"]
+    song_info.duration = int(data["duration"] or 0)
+    song_info.thumbnail = data["thumbnail"]
+    song_info.song_url = data["url"]
+    song_info.codec = data.get("acodec")
+    return song_info.song_url
+
+
+# Función para resolver en segundo plano la siguiente canción de la cola
+def prefetch_next_song(guild_id):
+    next_song = guild_states.get(guild_id).queue.peek()
+    if next_song is None or has_fresh_stream_url(next_song):
+        return
+
+    async def prefetch(song_info):
+        try:
+            await resolve_stream_url(song_info, guild_id)
+        except Exception:
+            logging.exception(f"Error al precargar la canción '{song_info.title}'")
+
+    task = asyncio.create_task(prefetch(next_song))
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_tasks.discard)
+
+
 # Función para manejar canciones de YouTube
-async def handle_youtube(ctx, query, voice_client, is_loop):
+async def handle_youtube(ctx, query, voice_client, is_loop, requested_at=None):
     guild_id = ctx.guild.id
     # Verificar si la consulta es una URL de YouTube
     if "youtube.com/watch?v=" in query or "youtu.be/" in query:
@@ -129,57 +372,61 @@ async def handle_youtube(ctx, query, voice_client, is_loop):
             await ctx.send("No se encontró la canción en YouTube.")
             return
 
-    # Extraer información
+    # La canción se crea sin URL de audio; resolve_stream_url la extrae justo a tiempo
     try:
-        data = await ytdl_extract_info(youtube_url)
-
-        song_info = {
-            "title": data["title"],
-            "duration": data["duration"],
-            "thumbnail": data["thumbnail"],
-            "song_url": data["url"],
-            "youtube_url": data["original_url"],
-        }
+        video_id = extract_video_id(youtube_url)
+        if not video_id:
+            # URL que no se reconoce: la extracción dice a qué video apunta
+            data = await ytdl_extract_info(youtube_url, guild_id)
+            video_id = data["id"]
+        youtube_url = youtube_watch_url(video_id)
+
+        # Dos >p simultáneos no pueden tomar los dos el camino de reproducir: el lock va
+        # desde la verificación hasta voice_client.play, y el segundo ya ve la canción sonando
+        state = guild_states.get(guild_id)
+        async with state.play_lock:
+            playing = voice_client.is_playing() or voice_client.is_paused()
+            if not playing:
+                # Si no hay nada reproduciéndose, la extracción hace falta ya: también trae los metadatos
+                metadata = await resolution_cache.get_metadata(video_id) or {"title": youtube_url, "duration": 0, "thumbnail": None}
+                song_info = Song(youtube_url=youtube_url, **metadata)
+                await resolve_stream_url(song_info, guild_id)
+                if is_loop:
+                    state.loop_song = song_info
+
+                await play_song(ctx, song_info, voice_client, is_loop, requested_at=requested_at)
 
         # Si hay una canción reproduciéndose, añadir a la cola
-        if voice_client.is_playing() or voice_client.is_paused():
-            if guild_id not in queues:
-                queues[guild_id] = []
+        if playing:
+            queue = state.queue
+            song_info = Song(youtube_url=youtube_url, **await fetch_video_metadata(video_id, guild_id))
 
             # Verificar si la canción ya está en la cola
-            if any(
-                song["youtube_url"] == song_info["youtube_url"]
-                for song in queues[guild_id]
-            ):
+            if song_info.video_id in queue:
                 await ctx.send("La canción ya está en la cola.")
                 return
 
-            queues[guild_id].append(song_info)
+            queue.append(song_info)
+            prefetch_next_song(guild_id)
             # Enviar un embed
             embed = discord.Embed(
                 title="🎶 Canción añadida a la cola",
-                description=f"[{song_info['title']}]({song_info['youtube_url']})",
+                description=f"[{song_info.title}]({song_info.youtube_url})",
                 color=discord.Color.green(),
             )
-            embed.set_thumbnail(url=song_info["thumbnail"])
+            embed.set_thumbnail(url=song_info.thumbnail)
             embed.add_field(
                 name="Duración",
-                value=format_duration(song_info["duration"]),
+                value=format_duration(song_info.duration),
                 inline=True,
             )
             embed.add_field(
                 name="En cola",
-                value=f"{len(queues.get(guild_id, []))} canciones",
+                value=format_queue_summary(queue),
                 inline=True,
             )
             embed.set_footer(text=f"Pedida por {ctx.author.display_name}")
             await ctx.send(embed=embed)
-        else:
-            # Si no hay nada reproduciéndose, reproducir la canción
-            if is_loop:
-                loop_song[guild_id] = song_info
-
-            await play_song(ctx, song_info, voice_client, is_loop)
 
     except Exception as e:
         logging.exception("Error al manejar la canción de YouTube")
@@ -187,14 +434,136 @@ async def handle_youtube(ctx, query, voice_client, is_loop):
 
 
 # Función para reproducir una canción
-async def play_song(ctx, song_info, voice_client, is_loop):
+async def play_song(ctx, song_info, voice_client, is_loop, requested_at=None):
     guild_id = ctx.guild.id
+    state = guild_states.get(guild_id)
+
+    # Si ya hay un buffer preparado para esta canción, se usa directamente
+    player = state.take_prepared(song_info)
+    if player is None:
+        try:
+            player = await create_audio_source(state, song_info)
+        except Exception as e:
+            logging.exception("Error al obtener el audio de la canción")
+            await ctx.send(f"No se pudo reproducir **{song_info.title}**: {e}")
+            if state.queue:
+                await play_next(ctx)
+            return
 
-    # Función 'after' para manejar el fin de la canción
+    # Solo la canción que un >p hace sonar de inmediato mide cuánto tardó desde el comando
+    if requested_at is not None:
+        observe_first_audio(player, requested_at)
+
+    # Reproducir la canción
+    try:
+        voice_client.play(player, after=make_after_playing(ctx, state, song_info, player, voice_client, is_loop))
+    except Exception as e:
+        logging.exception("Error al reproducir la canción")
+        player.cleanup()
+        await ctx.send(f"No se pudo reproducir **{song_info.title}**: {e}")
+        return
+
+    await song_started(ctx, state, song_info, player)
+
+
+# Función para crear la fuente de audio de una canción, con su buffer de frames
+async def create_audio_source(state, song_info):
+    capture = state.loop_capture
+    if capture is not None and (capture.song is not song_info or not state.loop):
+        # Los frames guardados eran de otra canción o el loop ya terminó
+        capture = state.loop_capture = None
+
+    if capture is not None and capture.ready:
+        # Repetición en loop: los frames ya están en memoria, sin FFmpeg ni red
+        return PrebufferedSource(
+            ReplaySource(capture.frames),
+            buffer_frames=Config.PREBUFFER_FRAMES,
+            on_first_frame=lambda: record_gap(state),
+        )
+    if capture is not None and capture.overflow:
+        # La canción no cabe en el presupuesto: el loop sigue usando FFmpeg
+        capture = None
+    elif state.loop:
+        # Una captura que no terminó completa (cortada, fallida o todavía en curso) no se
+        # continúa: se empieza otra en esta vuelta para no mezclar frames de dos fuentes
+        capture = state.loop_capture = FrameCapture(song_info, Config.LOOP_REPLAY_MAX_BYTES)
+
+    source = None
+    cached_path = await audio_cache.lookup(song_info.video_id) if audio_cache else None
+    if cached_path:
+        # Ya está en disco como Ogg/Opus: ni red ni FFmpeg
+        try:
+            source = await asyncio.to_thread(OggFileSource, cached_path)
+        except FileNotFoundError:
+            pass  # Se expulsó entre la consulta y la apertura: se reproduce desde la red
+    if source is None:
+        # Resolver la URL de audio justo a tiempo (solo si falta o está por expirar)
+        song_url = await resolve_stream_url(song_info, state.guild_id)
+        passthrough = await can_passthrough(song_info, song_url)
+        if passthrough:
+            source = discord.FFmpegOpusAudio(song_url, **ffmpeg_passthrough_options)
+        else:
+            source = discord.FFmpegOpusAudio(song_url, **ffmpeg_options)
+
+        if audio_cache and audio_cache.should_download(song_info.video_id, song_info.duration):
+            codec_args = ["-c:a", "copy"] if passthrough else audio_cache_transcode_args
+            audio_cache.schedule_download(song_info.video_id, song_url, codec_args)
+
+    return PrebufferedSource(
+        source,
+        buffer_frames=Config.PREBUFFER_FRAMES,
+        on_first_frame=lambda: record_gap(state),
+        capture=capture,
+    )
+
+
+# Función que registra el tiempo hasta el primer frame enviado a Discord
+def observe_first_audio(player, requested_at):
+    previous = player.on_first_frame
+
+    def on_first_frame():
+        if previous is not None:
+            previous()
+        metrics.time_to_first_audio.observe(time.perf_counter() - requested_at)
+
+    player.on_first_frame = on_first_frame
+
+
+# Función que indica si el audio de origen es Opus y se puede enviar sin recodificar
+async def can_passthrough(song_info, song_url):
+    if not Config.AUDIO_PASSTHROUGH:
+        return False
+    codec = song_info.codec
+    if codec in (None, "none"):
+        # yt-dlp no informó el códec: se consulta con ffprobe
+        codec, _ = await discord.FFmpegOpusAudio.probe(song_url, method="fallback")
+        song_info.codec = codec
+    return codec in ("opus", "libopus")
+
+
+# Función para registrar la pausa entre el final de una canción y el inicio de la siguiente
+def record_gap(state):
+    ended_at = state.track_ended_at
+    if ended_at is None:
+        return
+    state.track_ended_at = None
+    gap = time.perf_counter() - ended_at
+    gap_stats.record(gap)
+    logging.info(f"Pausa entre canciones en el servidor {state.guild_id}: {gap * 1000:.0f} ms")
+
+
+# Función 'after' para manejar el fin de la canción (se ejecuta en el hilo del reproductor)
+def make_after_playing(ctx, state, song_info, player, voice_client, is_loop):
     def after_playing(error):
         if error:
             logging.error(f"Error en after_playing: {error}")
-        if loop_flags.get(guild_id):
+        state.track_ended_at = player.ended_at or time.perf_counter()
+
+        # Si la siguiente canción ya tiene su buffer listo, arranca sin pasar por el event loop
+        if start_prepared_song(ctx, state, song_info, voice_client, is_loop):
+            return
+
+        if state.loop:
             # Reproducir la misma canción
             coro = play_song(ctx, song_info, voice_client, is_loop)
             asyncio.run_coroutine_threadsafe(coro, bot_discord.loop)
@@ -203,45 +572,130 @@ async def play_song(ctx, song_info, voice_client, is_loop):
             coro = play_next(ctx)
             asyncio.run_coroutine_threadsafe(coro, bot_discord.loop)
 
-    # Reproducir la canción
+    return after_playing
+
+
+# Función que arranca la siguiente canción con el buffer ya lleno
+def start_prepared_song(ctx, state, previous_song, voice_client, is_loop):
+    next_song = previous_song if state.loop else state.queue.peek()
+    if next_song is None:
+        return False
+    # El loop puede cambiar prepared en cualquier momento: se toma de forma atómica
+    source = state.take_prepared(next_song, discard_other=False)
+    if source is None:
+        return False
+    if not voice_client.is_connected():
+        source.cleanup()
+        return False
     try:
-        player = discord.FFmpegOpusAudio(song_info["song_url"], **ffmpeg_options)
-        voice_client.play(player, after=after_playing)
-    except Exception as e:
-        logging.exception("Error al reproducir la canción")
+        voice_client.play(source, after=make_after_playing(ctx, state, next_song, source, voice_client, is_loop))
+    except Exception:
+        logging.exception("Error al reproducir la canción precargada")
+        source.cleanup()
+        return False
+    coro = prepared_song_started(ctx, state, next_song, source)
+    asyncio.run_coroutine_threadsafe(coro, bot_discord.loop)
+    return True
+
+
+async def prepared_song_started(ctx, state, song_info, player):
+    if not state.loop and state.queue.peek() is song_info:
+        state.queue.popleft()
+    await song_started(ctx, state, song_info, player)
+
+
+# Función con lo que se hace cada vez que empieza a sonar una canción
+async def song_started(ctx, state, song_info, player):
+    # Mientras suena, dejar lista la siguiente canción
+    prefetch_next_song(state.guild_id)
+    schedule_prebuffer(state, song_info, player)
 
     # Enviar un embed
     embed = discord.Embed(
         title="🎶 Ahora suena",
-        description=f"[{song_info['title']}]({song_info['youtube_url']})",
+        description=f"[{song_info.title}]({song_info.youtube_url})",
         color=discord.Color.blue(),
     )
-    embed.set_thumbnail(url=song_info["thumbnail"])
+    embed.set_thumbnail(url=song_info.thumbnail)
     embed.add_field(
-        name="Duración", value=format_duration(song_info["duration"]), inline=True
+        name="Duración", value=format_duration(song_info.duration), inline=True
     )
     embed.add_field(
-        name="En cola", value=f"{len(queues.get(guild_id, []))} canciones", inline=True
+        name="En cola", value=format_queue_summary(state.queue), inline=True
     )
     embed.set_footer(text=f"Pedida por {ctx.author.display_name}")
     await ctx.send(embed=embed)
 
 
+# Función para programar el prebuffer de la siguiente canción
+def schedule_prebuffer(state, song_info, player):
+    if state.prebuffer_task is not None:
+        state.prebuffer_task.cancel()
+        state.prebuffer_task = None
+    if not Config.GAPLESS_PLAYBACK or player is None:
+        return
+    state.prebuffer_task = asyncio.create_task(prebuffer_next_song(state, song_info, player))
+
+
+# Función que, poco antes de que termine la canción, arranca FFmpeg para la siguiente y llena su buffer
+async def prebuffer_next_song(state, song_info, player):
+    # Se mide con los frames ya enviados, así las pausas no adelantan el prebuffer
+    while player.elapsed < song_info.duration - Config.PREBUFFER_LEAD_SECONDS:
+        if player.ended_at is not None:
+            return
+        await asyncio.sleep(1)
+
+    next_song = song_info if state.loop else state.queue.peek()
+    if next_song is None or player.ended_at is not None:
+        return
+
+    # En loop se espera a terminar de capturar los frames para repetir desde memoria
+    capture = state.loop_capture
+    while (
+        state.loop
+        and capture is not None
+        and capture.song is next_song
+        and not capture.complete
+        and not capture.discarded
+        and player.ended_at is None
+    ):
+        await asyncio.sleep(0.2)
+    if player.ended_at is not None:
+        return
+
+    try:
+        source = await create_audio_source(state, next_song)
+    except Exception:
+        logging.exception(f"Error al precargar el audio de '{next_song.title}'")
+        return
+
+    try:
+        await asyncio.to_thread(source.wait_ready, Config.PREBUFFER_LEAD_SECONDS)
+    except asyncio.CancelledError:
+        source.cleanup()
+        raise
+    state.set_prepared(next_song, source)
+
+
 # Función para reproducir la siguiente canción
 async def play_next(ctx):
     guild_id = ctx.guild.id
     voice_client = ctx.voice_client
 
+    state = guild_states.get(guild_id)
+
     # Si la cola no está vacía
-    if guild_id in queues and queues[guild_id]:
-        next_song = queues[guild_id].pop(0)
+    if state.queue:
+        next_song = state.queue.popleft()
         await play_song(ctx, next_song, voice_client, is_loop=False)
     else:
         # No hay más canciones, desconectar
-        loop_flags[guild_id] = False
+        state.loop = False
+        state.track_ended_at = None
         if voice_client and voice_client.is_connected():
             await voice_client.disconnect()
-            voice_clients.pop(guild_id, None)
+        if not state.imports:
+            guild_states.discard(guild_id)
 
 
 # Función para formatear duración
@@ -251,52 +705,118 @@ def format_duration(duration):
     return f"{minutes}:{seconds:02d}"
 
 
+# Función para resumir el tamaño y la duración de una cola
+def format_queue_summary(queue):
+    if not queue:
+        return "0 canciones"
+    return f"{len(queue)} canciones ({format_duration(queue.total_duration)})"
+
+
 # Función para buscar en YouTube
 async def search_youtube(query):
+    video_id = await resolution_cache.get_video_id(query)
+    if video_id:
+        return youtube_watch_url(video_id)
+    return await single_flight.do("search", normalize_query(query), search_youtube_results, query)
+
+
+async def search_youtube_results(query):
     query_string = urllib.parse.urlencode({"search_query": query})
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
+    with metrics.search_duration.time():
+        async with http_client.session.get(
             f"https://www.youtube.com/results?{query_string}"
         ) as response:
             if response.status == 200:
                 html = await response.text()
-                search_results = re.findall(r"/watch\?v=(.{11})", html)
-                if search_results:
-                    return f"https://www.youtube.com/watch?v={search_results[0]}"
+            else:
+                html = ""
+    search_results = re.findall(r"/watch\?v=(.{11})", html)
+    if search_results:
+        resolution_cache.set_video_id(query, search_results[0])
+        return youtube_watch_url(search_results[0])
     return None
 
 
-# Función para obtener canciones de una playlist de Spotify
-def get_spotify_playlist_tracks(playlist_url):
+# Campos que se piden a Spotify, para no descargar la playlist completa en cada página
+PLAYLIST_FIELDS = "id,name,owner(display_name),images(url),tracks(total)"
+PLAYLIST_ITEMS_FIELDS = "items(track(name,duration_ms,artists(name),album(images(url)))),next"
+PLAYLIST_PAGE_SIZE = 100
+
+
+# Función para obtener el id de una playlist de Spotify a partir de su URL o URI
+def spotify_playlist_id(playlist_url):
+    match = re.search(r"playlist[/:]([0-9A-Za-z]+)", playlist_url)
+    return match.group(1) if match else playlist_url
+
+
+# Función para obtener los datos generales de una playlist de Spotify
+async def get_spotify_playlist(playlist_url):
     try:
-        playlist = client_spotipy.playlist(playlist_url)
-        playlist_name = playlist["name"]
-        playlist_owner = playlist["owner"]["display_name"]
-        tracks = []
-        total_duration_ms = 0
-
-        for item in playlist["tracks"]["items"]:
-            track = item["track"]
-            artist_name = track["artists"][0]["name"]
-            song_name = track["name"]
-            song_duration_ms = track["duration_ms"]
-            tracks.append({"artist": artist_name, "title": song_name})
-            total_duration_ms += song_duration_ms
-
-        total_duration_minutes = total_duration_ms // 60000
-        total_duration_hours = total_duration_minutes // 60
-        total_duration_str = f"{total_duration_hours}h {total_duration_minutes % 60}m"
-
-        image_url = playlist["images"][0]["url"] if playlist["images"] else None
-
-        return {
-            "name": playlist_name,
-            "owner": playlist_owner,
-            "tracks": tracks,
-            "total_duration": total_duration_str,
-            "total_tracks": len(tracks),
-            "image": image_url,
-        }
-    except Exception as e:
-        logging.exception("Error al obtener canciones de la playlist de Spotify")
+        playlist = await single_flight.do(
+            "playlist",
+            spotify_playlist_id(playlist_url),
+            spotify_client.playlist,
+            spotify_playlist_id(playlist_url),
+            fields=PLAYLIST_FIELDS,
+        )
+    except Exception:
+        logging.exception("Error al obtener la playlist de Spotify")
         return None
+
+    return {
+        "id": playlist["id"],
+        "name": playlist["name"],
+        "owner": playlist["owner"]["display_name"],
+        "image": playlist["images"][0]["url"] if playlist["images"] else None,
+        "total_tracks": playlist["tracks"]["total"],
+        # Se actualizan a medida que se recorren las canciones
+        "loaded_tracks": 0,
+        "total_duration_ms": 0,
+    }
+
+
+# Generador que recorre todas las páginas de la playlist y entrega las canciones al llegar
+async def get_spotify_playlist_tracks(playlist):
+    def fetch_page(offset):
+        return asyncio.create_task(
+            spotify_client.playlist_items(
+                playlist["id"],
+                fields=PLAYLIST_ITEMS_FIELDS,
+                limit=PLAYLIST_PAGE_SIZE,
+                offset=offset,
+                additional_types=("track",),
+            )
+        )
+
+    offset = 0
+    next_page = fetch_page(offset)
+    try:
+        while next_page is not None:
+            page = await next_page
+            offset += len(page["items"])
+            # La siguiente página se pide mientras se procesa la actual
+            next_page = fetch_page(offset) if page.get("next") and page["items"] else None
+
+            for item in page["items"]:
+                track = item.get("track")
+                if not track or not track.get("artists"):
+                    continue
+                images = track["album"]["images"]
+                playlist["loaded_tracks"] += 1
+                playlist["total_duration_ms"] += track["duration_ms"]
+                yield {
+                    "artist": track["artists"][0]["name"],
+                    "title": track["name"],
+                    "duration": track["duration_ms"] // 1000,
+                    "image": images[0]["url"] if images else None,
+                }
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+# Función para formatear la duración total de una playlist
+def format_playlist_duration(duration_ms):
+    total_duration_minutes = duration_ms // 60000
+    total_duration_hours = total_duration_minutes // 60
+    return f"{total_duration_hours}h {total_duration_minutes % 60}m"
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Función para normalizar una búsqueda y usarla como llave de caché
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+# Función para obtener el id de video de una URL de YouTube
+def extract_video_id(url):
+    match = re.search(r"(?:v=|youtu\.be/|/shorts/)([0-9A-Za-z_-]{11})", url or "")
+    return match.group(1) if match else None
+
+
+class LRUCache:
+    """
+    Caché en memoria con expiración (TTL) y tamaño máximo; descarta el menos usado.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, stored_at = item
+        if time.time() - stored_at > self.ttl:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value, stored_at=None):
+        self._items[key] = (value, stored_at or time.time())
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ResolutionCache:
+    """
+    Caché de dos niveles (memoria + SQLite) para las resoluciones de YouTube:
+    búsqueda normalizada -> id de video, e id de video -> metadatos.
+
+    El event loop nunca toca el disco: las lecturas que no están en memoria
+    van a un hilo con asyncio.to_thread, y las escrituras se encolan para un
+    hilo escritor que las agrupa en una sola transacción cada flush_interval.
+    """
+
+    def __init__(
+        self,
+        path,
+        memory_size=1024,
+        disk_size=50000,
+        query_ttl=7 * 86400,
+        metadata_ttl=30 * 86400,
+        flush_interval=1.0,
+        max_batch=500,
+    ):
+        self.path = path
+        self.disk_size = disk_size
+        self.query_ttl = query_ttl
+        self.metadata_ttl = metadata_ttl
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queries = LRUCache(memory_size, query_ttl)
+        self.videos = LRUCache(memory_size, metadata_ttl)
+        self.counters = {
+            "query_memory_hits": 0,
+            "query_disk_hits": 0,
+            "query_misses": 0,
+            "metadata_memory_hits": 0,
+            "metadata_disk_hits": 0,
+            "metadata_misses": 0,
+            "disk_commits": 0,
+        }
+        self._connection = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._pending = queue.Queue()
+        self._writer = None
+
+    def _db(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._connection.executescript(
+                """
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS queries (
+                    query TEXT PRIMARY KEY, video_id TEXT NOT NULL, stored_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS videos (
+                    video_id TEXT PRIMARY KEY, title TEXT, duration INTEGER, thumbnail TEXT, stored_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS queries_stored_at ON queries (stored_at);
+                CREATE INDEX IF NOT EXISTS videos_stored_at ON videos (stored_at);
+                """
+            )
+        return self._connection
+
+    def _read(self, statement, params):
+        with self._lock:
+            return self._db().execute(statement, params).fetchone()
+
+    async def get_video_id(self, query):
+        key = normalize_query(query)
+        video_id = self.queries.get(key)
+        if video_id is not None:
+            self.counters["query_memory_hits"] += 1
+            return video_id
+
+        row = await asyncio.to_thread(
+            self._read,
+            "SELECT video_id, stored_at FROM queries WHERE query = ? AND stored_at > ?",
+            (key, time.time() - self.query_ttl),
+        )
+        if row is None:
+            self.counters["query_misses"] += 1
+            return None
+        self.counters["query_disk_hits"] += 1
+        self.queries.set(key, row[0], row[1])
+        return row[0]
+
+    def set_video_id(self, query, video_id):
+        key = normalize_query(query)
+        stored_at = time.time()
+        self.queries.set(key, video_id, stored_at)
+        self._write("INSERT OR REPLACE INTO queries VALUES (?, ?, ?)", (key, video_id, stored_at))
+
+    async def get_metadata(self, video_id):
+        metadata = self.videos.get(video_id)
+        if metadata is not None:
+            self.counters["metadata_memory_hits"] += 1
+            return dict(metadata)
+
+        row = await asyncio.to_thread(
+            self._read,
+            "SELECT title, duration, thumbnail, stored_at FROM videos WHERE video_id = ? AND stored_at > ?",
+            (video_id, time.time() - self.metadata_ttl),
+        )
+        if row is None:
+            self.counters["metadata_misses"] += 1
+            return None
+        self.counters["metadata_disk_hits"] += 1
+        metadata = {"title": row[0], "duration": row[1], "thumbnail": row[2]}
+        self.videos.set(video_id, metadata, row[3])
+        return dict(metadata)
+
+    def set_metadata(self, video_id, title, duration, thumbnail):
+        stored_at = time.time()
+        self.videos.set(video_id, {"title": title, "duration": duration, "thumbnail": thumbnail}, stored_at)
+        self._write(
+            "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)",
+            (video_id, title, duration, thumbnail, stored_at),
+        )
+
+    def _write(self, statement, params):
+        # La memoria ya está actualizada; el disco se escribe en el hilo escritor
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name="resolution-cache-writer", daemon=True)
+            self._writer.start()
+        self._pending.put((statement, params))
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            batch = [item]
+            # Espera un poco para juntar las escrituras cercanas en un solo commit
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._flush(batch)
+            except sqlite3.Error:
+                logging.exception("No se pudo escribir en la caché de resoluciones")
+            if stop:
+                return
+
+    def _flush(self, batch):
+        with self._lock:
+            db = self._db()
+            for statement, params in batch:
+                db.execute(statement, params)
+            previous_writes = self._writes
+            self._writes += len(batch)
+            # La poda se hace cada cierto número de escrituras para que sea barata
+            if self._writes // 100 != previous_writes // 100:
+                self._evict(db)
+            db.commit()
+            self.counters["disk_commits"] += 1
+
+    def _evict(self, db):
+        expired_at = time.time()
+        db.execute("DELETE FROM queries WHERE stored_at < ?", (expired_at - self.query_ttl,))
+        db.execute("DELETE FROM videos WHERE stored_at < ?", (expired_at - self.metadata_ttl,))
+        for table in ("queries", "videos"):
+            (count,) = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+            if count > self.disk_size:
+                db.execute(
+                    f"DELETE FROM {table} WHERE rowid IN "
+                    f"(SELECT rowid FROM {table} ORDER BY stored_at LIMIT ?)",
+                    (count - self.disk_size,),
+                )
+
+    def stats(self):
+        return {
+            **self.counters,
+            "memory_queries": len(self.queries),
+            "memory_videos": len(self.videos),
+            "pending_writes": self._pending.qsize(),
+        }
+
+    def close(self):
+        # Vacía las escrituras pendientes antes de cerrar la conexión
+        if self._writer is not None and self._writer.is_alive():
+            self._pending.put(None)
+            self._writer.join()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,249 @@
+"""
+Pool de procesos para yt-dlp. Cada proceso mantiene un YoutubeDL ya
+inicializado y atiende una extracción a la vez, fuera del GIL del bot.
+
+El proceso hijo se lanza como: python -m play_music.extractor <opciones JSON>
+y habla por stdin/stdout con una línea JSON por petición y por respuesta.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from collections import OrderedDict, deque
+
+# Campos de la respuesta de yt-dlp que usa el bot; el resto no cruza el pipe
+FIELDS = ("id", "title", "duration", "thumbnail", "url", "acodec")
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class ExtractorBusy(ExtractionError):
+    pass
+
+
+class ExtractorWorker:
+    """
+    Un proceso de yt-dlp. Si una extracción supera el timeout el proceso se
+    mata y se vuelve a lanzar, porque yt-dlp no se puede interrumpir.
+    """
+
+    def __init__(self, index, options):
+        self.index = index
+        self.options = options
+        self.process = None
+        self.busy = False
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "play_music.extractor",
+            json.dumps(self.options),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=PROJECT_ROOT,
+            limit=1024 * 1024,
+        )
+
+    async def extract(self, url, timeout):
+        if not self.alive:
+            await self.start()
+        self.process.stdin.write(json.dumps(url).encode() + b"\n")
+        await self.process.stdin.drain()
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        if not line:
+            raise ExtractionError("El proceso de extracción terminó inesperadamente.")
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise ExtractionError(reply["error"])
+        return reply["data"]
+
+    async def stop(self):
+        if not self.alive:
+            return
+        self.process.kill()
+        await self.process.wait()
+
+
+class ExtractorPool:
+    """
+    Reparte las extracciones entre los procesos por turnos entre servidores
+    (round robin), para que un servidor con muchas peticiones no haga esperar
+    a los demás. Con max_pending peticiones en espera se rechazan las nuevas.
+    """
+
+    def __init__(self, options, workers=2, timeout=30, max_pending=64, max_pending_per_guild=16):
+        self.options = options
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_pending_per_guild = max_pending_per_guild
+        self.workers = [ExtractorWorker(index, options) for index in range(workers)]
+        self._queues = OrderedDict()  # servidor -> deque de (url, future), en orden de turno
+        self._pending = 0
+        self._condition = None
+        self._tasks = []
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+    def start(self):
+        """
+        Lanza los procesos para que el primer >p no espere a que arranquen.
+        """
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        self._condition = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._run_worker(worker)) for worker in self.workers]
+
+    async def extract(self, url, guild_id=None):
+        """
+        Devuelve los campos FIELDS de la extracción. Si quien espera se cancela
+        antes de que un proceso tome la petición, esta se descarta; si ya la
+        estaba atendiendo, el resultado se ignora.
+        """
+        self._ensure_started()
+        queue = self._queues.get(guild_id)
+        if self._pending >= self.max_pending or (queue and len(queue) >= self.max_pending_per_guild):
+            self.rejected += 1
+            raise ExtractorBusy("Hay demasiadas canciones resolviéndose, inténtalo en unos segundos.")
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._queues[guild_id] = deque()
+        queue.append((url, future, time.monotonic()))
+        self._pending += 1
+        async with self._condition:
+            self._condition.notify()
+        return await future
+
+    def _next_job(self):
+        while self._queues:
+            guild_id, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            self._pending -= 1
+            if queue:
+                self._queues.move_to_end(guild_id)  # El servidor pasa al final del turno
+            else:
+                del self._queues[guild_id]
+            if not job[1].done():
+                return job
+        return None
+
+    async def _run_worker(self, worker):
+        try:
+            await worker.start()
+        except Exception:
+            logging.exception("No se pudo lanzar el proceso de extracción")
+        while True:
+            async with self._condition:
+                job = self._next_job()
+                while job is None:
+                    await self._condition.wait()
+                    job = self._next_job()
+
+            url, future, queued_at = job
+            self.total_wait += time.monotonic() - queued_at
+            worker.busy = True
+            try:
+                data = await worker.extract(url, self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                await self._restart(worker)
+                if not future.done():
+                    future.set_exception(ExtractionError(f"La extracción tardó más de {self.timeout}s."))
+            except asyncio.CancelledError:
+                await worker.stop()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not worker.alive:
+                    await self._restart(worker)
+                if not future.done():
+                    future.set_exception(e if isinstance(e, ExtractionError) else ExtractionError(str(e)))
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(data)
+            finally:
+                worker.busy = False
+
+    async def _restart(self, worker):
+        self.restarts += 1
+        logging.warning(f"Reiniciando el proceso de extracción {worker.index}")
+        await worker.stop()
+        try:
+            await worker.start()
+        except Exception:
+            logging.exception("No se pudo relanzar el proceso de extracción")
+
+    def stats(self):
+        served = self.completed + self.failed + self.timeouts
+        return {
+            "workers": len(self.workers),
+            "busy": sum(worker.busy for worker in self.workers),
+            "pending": self._pending,
+            "guilds_waiting": len(self._queues),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+            "rejected": self.rejected,
+            "average_wait": self.total_wait / served if served else 0.0,
+        }
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for worker in self.workers:
+            await worker.stop()
+        for queue in self._queues.values():
+            for _, future, _ in queue:
+                future.cancel()
+        self._queues.clear()
+        self._pending = 0
+
+
+def main():
+    # Ctrl+C llega a todo el grupo de procesos; el bot se encarga de cerrar este
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import yt_dlp
+
+    options = json.loads(sys.argv[1])
+    # stdout queda reservado para las respuestas; lo que imprima yt-dlp va a stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    ytdl = yt_dlp.YoutubeDL(options)
+
+    for line in sys.stdin:
+        url = json.loads(line)
+        try:
+            data = ytdl.extract_info(url, download=False)
+            reply = {"ok": True, "data": {field: data.get(field) for field in FIELDS}}
+        except Exception as e:
+            reply = {"ok": False, "error": str(e)}
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import random
+from collections import Counter, deque
+from itertools import islice
+
+from play_music.cache import extract_video_id
+
+
+class Song:
+    """
+    Registro compacto de una canción en cola; song_url se resuelve al reproducir.
+    """
+
+    __slots__ = ("title", "duration", "thumbnail", "youtube_url", "video_id", "song_url", "codec", "queued_duration")
+
+    def __init__(self, title, duration, thumbnail, youtube_url, song_url=None, codec=None):
+        self.title = title
+        self.duration = int(duration or 0)
+        self.thumbnail = thumbnail
+        self.youtube_url = youtube_url
+        self.video_id = extract_video_id(youtube_url)
+        self.song_url = song_url
+        self.codec = codec  # Códec de audio de song_url, ej. "opus"
+        # Duración sumada al total de la cola; duration puede cambiar al resolver la canción
+        self.queued_duration = 0
+
+    def __repr__(self):
+        return f"Song({self.title!r}, {self.video_id!r})"
+
+
+class GuildQueue:
+    """
+    Cola de reproducción de un servidor: deque de canciones con índice de
+    ids de video (pertenencia en O(1)) y totales acumulados.
+    """
+
+    def __init__(self):
+        self._songs = deque()
+        self._video_ids = Counter()
+        self.total_duration = 0
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __iter__(self):
+        return iter(self._songs)
+
+    def __contains__(self, video_id):
+        return self._video_ids[video_id] > 0
+
+    def _added(self, song):
+        self._video_ids[song.video_id] += 1
+        song.queued_duration = song.duration
+        self.total_duration += song.queued_duration
+
+    def _removed(self, song):
+        self._video_ids[song.video_id] -= 1
+        if self._video_ids[song.video_id] <= 0:
+            del self._video_ids[song.video_id]
+        self.total_duration -= song.queued_duration
+
+    def append(self, song):
+        self._songs.append(song)
+        self._added(song)
+
+    def popleft(self):
+        song = self._songs.popleft()
+        self._removed(song)
+        return song
+
+    def peek(self):
+        return self._songs[0] if self._songs else None
+
+    def head(self, count):
+        return list(islice(self._songs, count))
+
+    def remove(self, position):
+        """
+        Quita la canción en la posición indicada (base 0) y la devuelve.
+        """
+        song = self._songs[position]
+        del self._songs[position]
+        self._removed(song)
+        return song
+
+    def move(self, source, target):
+        """
+        Mueve la canción de la posición source a la posición target (base 0).
+        """
+        song = self._songs[source]
+        del self._songs[source]
+        self._songs.insert(target, song)
+        return song
+
+    def shuffle(self):
+        songs = list(self._songs)
+        random.shuffle(songs)
+        self._songs = deque(songs)
+
+    def clear(self):
+        self._songs.clear()
+        self._video_ids.clear()
+        self.total_duration = 0
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+
+from play_music.guild_queue import GuildQueue
+
+
+class GuildState:
+    """
+    Estado de reproducción de un servidor.
+    """
+
+    __slots__ = (
+        "guild_id",
+        "queue",
+        "voice_client",
+        "loop",
+        "loop_song",
+        "imports",
+        "import_semaphore",
+        "prepared",
+        "prepared_lock",
+        "play_lock",
+        "prebuffer_task",
+        "track_ended_at",
+        "loop_capture",
+        "last_active",
+    )
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = GuildQueue()
+        self.voice_client = None
+        self.loop = False
+        self.loop_song = None
+        self.imports = set()  # Importaciones de playlists en curso
+        self.import_semaphore = None
+        self.prepared = None  # (canción, fuente con buffer) lista para sonar a continuación
+        # prepared se toma desde el hilo del reproductor (after) y se cambia desde el loop
+        self.prepared_lock = threading.Lock()
+        # Serializa en el loop la decisión de reproducir ya o encolar
+        self.play_lock = asyncio.Lock()
+        self.prebuffer_task = None
+        self.track_ended_at = None
+        self.loop_capture = None  # Frames de la canción en loop, para repetirla desde memoria
+        self.last_active = time.monotonic()
+
+    def is_active(self):
+        # Un reproductor en pausa no está inactivo: el usuario puede reanudarlo en cualquier momento
+        voice_client = self.voice_client
+        return bool(
+            voice_client and voice_client.is_connected() and (voice_client.is_playing() or voice_client.is_paused())
+        )
+
+    def set_prepared(self, song_info, source):
+        with self.prepared_lock:
+            previous, self.prepared = self.prepared, (song_info, source)
+        if previous is not None:
+            previous[1].cleanup()
+
+    def take_prepared(self, song_info, discard_other=True):
+        """
+        Devuelve la fuente preparada si es de song_info, o None. Si es de otra
+        canción se descarta (o se deja, con discard_other=False).
+        """
+        with self.prepared_lock:
+            prepared = self.prepared
+            if prepared is None or (prepared[0] is not song_info and not discard_other):
+                return None
+            self.prepared = None
+        if prepared[0] is not song_info:
+            prepared[1].cleanup()
+            return None
+        return prepared[1]
+
+    def clear_prepared(self):
+        with self.prepared_lock:
+            prepared, self.prepared = self.prepared, None
+        if prepared is not None:
+            prepared[1].cleanup()
+
+    def footprint(self):
+        """
+        Estimación en bytes de la memoria que ocupa el estado (cola incluida).
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.queue._songs) + sys.getsizeof(self.queue._video_ids)
+        for song in self.queue:
+            size += sys.getsizeof(song)
+            for value in (song.title, song.thumbnail, song.youtube_url, song.video_id, song.song_url):
+                if value is not None:
+                    size += sys.getsizeof(value)
+        if self.loop_capture is not None:
+            size += self.loop_capture.size
+        return size
+
+
+class GuildStateManager:
+    """
+    Dueño de todo el estado por servidor. Un barrido periódico desconecta los
+    clientes de voz inactivos, descarta estados viejos y respeta un presupuesto
+    de memoria expulsando primero a los servidores inactivos hace más tiempo.
+    """
+
+    def __init__(
+        self,
+        idle_timeout=300,
+        state_ttl=3600,
+        memory_budget=64 * 1024 * 1024,
+        sweep_interval=60,
+    ):
+        self.idle_timeout = idle_timeout
+        self.state_ttl = state_ttl
+        self.memory_budget = memory_budget
+        self.sweep_interval = sweep_interval
+        self._states = {}
+        self._task = None
+        self.evictions = 0
+        self.idle_disconnects = 0
+
+    def get(self, guild_id):
+        state = self._states.get(guild_id)
+        if state is None:
+            state = self._states[guild_id] = GuildState(guild_id)
+        state.last_active = time.monotonic()
+        return state
+
+    def peek(self, guild_id):
+        return self._states.get(guild_id)
+
+    def discard(self, guild_id):
+        state = self._states.pop(guild_id, None)
+        if state is not None:
+            for task in state.imports:
+                task.cancel()
+            state.imports.clear()
+            state.queue.clear()
+            if state.prebuffer_task is not None:
+                state.prebuffer_task.cancel()
+            state.clear_prepared()
+            state.loop_capture = None
+        return state
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return iter(list(self._states.values()))
+
+    def metrics(self):
+        footprints = {guild_id: state.footprint() for guild_id, state in self._states.items()}
+        return {
+            "guilds": len(self._states),
+            "total_bytes": sum(footprints.values()),
+            "guild_bytes": footprints,
+            "evictions": self.evictions,
+            "idle_disconnects": self.idle_disconnects,
+        }
+
+    async def sweep(self):
+        now = time.monotonic()
+        for state in self:
+            if state.is_active() or state.imports:
+                state.last_active = now
+                continue
+
+            idle = now - state.last_active
+            voice_client = state.voice_client
+            if voice_client and voice_client.is_connected():
+                if idle >= self.idle_timeout:
+                    logging.info(f"Desconectando el cliente de voz inactivo del servidor {state.guild_id}")
+                    try:
+                        await voice_client.disconnect()
+                    except Exception:
+                        logging.exception("Error al desconectar un cliente de voz inactivo")
+                    self.idle_disconnects += 1
+                    self.discard(state.guild_id)
+            elif idle >= self.state_ttl:
+                self.discard(state.guild_id)
+                self.evictions += 1
+
+        self.enforce_memory_budget()
+
+    def enforce_memory_budget(self):
+        footprints = {guild_id: state.footprint() for guild_id, state in self._states.items()}
+        total = sum(footprints.values())
+        if total <= self.memory_budget:
+            return
+        # Se expulsan primero los servidores que no están reproduciendo ni en pausa, del más antiguo al más reciente
+        candidates = sorted(
+            (state for state in self._states.values() if not state.is_active() and not state.imports),
+            key=lambda state: state.last_active,
+        )
+        for state in candidates:
+            if total <= self.memory_budget:
+                break
+            total -= footprints[state.guild_id]
+            if state.voice_client and state.voice_client.is_connected():
+                asyncio.create_task(state.voice_client.disconnect())
+            self.discard(state.guild_id)
+            self.evictions += 1
+        if total > self.memory_budget:
+            logging.warning(f"El estado de los servidores activos ocupa {total} bytes, sobre el presupuesto")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logging.exception("Error al barrer el estado de los servidores")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,39 @@
+import asyncio
+
+# Máximo de ids por llamada que aceptan los endpoints masivos de Spotify
+TRACKS_BATCH_SIZE = 50
+AUDIO_FEATURES_BATCH_SIZE = 100
+
+
+def unique_ids(ids):
+    """
+    Quita ids vacíos y repetidos conservando el orden.
+    """
+    return list(dict.fromkeys(item for item in ids if item))
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+async def fetch_tracks(spotify, track_ids):
+    """
+    Obtiene las canciones en lotes de 50; devuelve {track_id: track}.
+    Los lotes se piden en paralelo, dentro del límite por endpoint del cliente.
+    """
+    pages = await asyncio.gather(
+        *(spotify.tracks(chunk) for chunk in chunks(unique_ids(track_ids), TRACKS_BATCH_SIZE))
+    )
+    return {track["id"]: track for page in pages for track in page["tracks"] if track}
+
+
+async def fetch_audio_features(spotify, track_ids):
+    """
+    Obtiene las características de audio en lotes de 100; devuelve {track_id: features}.
+    """
+    pages = await asyncio.gather(
+        *(spotify.audio_features(chunk) for chunk in chunks(unique_ids(track_ids), AUDIO_FEATURES_BATCH_SIZE))
+    )
+    return {item["id"]: item for page in pages for item in page if item}
+
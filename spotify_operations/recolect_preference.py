@@ -1,10 +1,12 @@
-import pandas as pd
-from spotipy import Spotify
+import asyncio
 
 from commons.db import MongoDB
+from commons.spotify_client import SpotifyClient
+from machine_learning.process import agrega_preferencias
+from spotify_operations.batch import fetch_audio_features, fetch_tracks
 
 
-async def recolecta_preferencias(user_id):
+async def recolecta_preferencias(user_id, spotify: SpotifyClient):
     # Obtén el token del usuario desde MongoDB
     mongo = MongoDB("bot_spotipy")
     user = await mongo.find_document(
@@ -16,11 +18,13 @@ async def recolecta_preferencias(user_id):
     if user is None and not user.get("token_info"):
         return {"message": "Error al obtener el token de acceso."}
 
-    sp = Spotify(auth=user["token_info"]["access_token"])
+    sp = spotify.as_user(user["token_info"]["access_token"])
 
     # Extrae canciones y artistas favoritos
-    top_tracks = sp.current_user_top_tracks(limit=10)
-    top_artists = sp.current_user_top_artists(limit=10)
+    top_tracks, top_artists = await asyncio.gather(
+        sp.current_user_top_tracks(limit=10),
+        sp.current_user_top_artists(limit=10),
+    )
 
     track_ids = [track["id"] for track in top_tracks["items"]]
     artist_ids = [artist["id"] for artist in top_artists["items"]]
@@ -33,30 +37,26 @@ async def recolecta_preferencias(user_id):
         {"$set": {"top_tracks": track_ids, "top_artists": artist_ids}},
         upsert=True,  # Crea el documento si no existe
     )
-    await construye_dataset(user)
+    await construye_dataset(user, spotify)
     return
 
 
-async def construye_dataset(user: dict):
+async def construye_dataset(user: dict, spotify: SpotifyClient):
 
-    sp = Spotify(auth=user["token_info"]["access_token"])
+    sp = spotify.as_user(user["token_info"]["access_token"])
 
-    await guarda_caracteristicas_en_mongo(user, sp)  # Guarda como CSV
+    await guarda_caracteristicas_en_mongo(user, sp)  # Guarda en MongoDB y en el dataset
     return
 
 
-async def guarda_dataset_csv(dataset):
-    df = pd.DataFrame(dataset)
-    # 'a' para agregar y 'header=False' para no duplicar los encabezados si el archivo ya existe
-    df.to_csv("dataset.csv", mode="a", header=not pd.io.common.file_exists("dataset.csv"), index=False)
-
-
-async def extrae_caracteristicas_canciones(track_ids, sp: Spotify):
-    audio_features = sp.audio_features(track_ids)
+async def extrae_caracteristicas_canciones(track_ids, sp: SpotifyClient):
+    audio_features = await fetch_audio_features(sp, track_ids)
+    # La popularidad viene del endpoint de canciones, también en lote
+    tracks = await fetch_tracks(sp, list(audio_features))
 
     caracteristicas_canciones = []
-    for features in audio_features:
-        if features:
+    for features in audio_features.values():
+        if features["id"] in tracks:
             caracteristicas_canciones.append(
                 {
                     "track_id": features["id"],
@@ -64,27 +64,27 @@ async def extrae_caracteristicas_canciones(track_ids, sp: Spotify):
                     "energy": features["energy"],
                     "valence": features["valence"],
                     "tempo": features["tempo"],
-                    "popularity": sp.track(features["id"])["popularity"],  # Añade popularidad
+                    "popularity": tracks[features["id"]]["popularity"],  # Añade popularidad
                     # Agrega más atributos relevantes aquí si es necesario
                 }
             )
     return caracteristicas_canciones
 
 
-async def guarda_caracteristicas_en_mongo(user: dict, sp: Spotify):
+async def guarda_caracteristicas_en_mongo(user: dict, sp: SpotifyClient):
     mongo = MongoDB("bot_spotipy")  # Instancia MongoDB si no lo tienes globalmente
 
     track_ids = user["top_tracks"]
 
     caracteristicas_canciones = await extrae_caracteristicas_canciones(track_ids, sp)
-    data_set = []
-    for caracteristica in caracteristicas_canciones:
-        document = {
+    data_set = [
+        {
             "user_id": user["user_id"],
-            "track_id": caracteristica["track_id"],
             **caracteristica,  # Agrega más atributos relevantes aquí si es necesario
         }
-        await mongo.insert_document(collection="dataset", document=document)
-        del document["_id"]
-        data_set.append(document)
-    await guarda_dataset_csv(data_set)
+        for caracteristica in caracteristicas_canciones
+    ]
+    # Un solo bulk_write; refrescar las preferencias no duplica filas
+    await mongo.bulk_upsert(data_set, collection="dataset", keys=("user_id", "track_id"))
+    # Upsert en el dataset columnar y en el motor de recomendaciones, fuera del event loop
+    await asyncio.to_thread(agrega_preferencias, data_set)
@@ -1,13 +1,12 @@
 import discord
-import spotipy
 
-from commons.config import bot_discord, client_spotipy
+from commons.spotify_client import SpotifyClient
 
 
-async def spotipy_recomendar(ctx, client_spotipy: spotipy.Spotify, tipo: str):
+async def spotipy_recomendar(ctx, spotify: SpotifyClient, tipo: str):
     try:
         if tipo == "cancion":
-            top_tracks = client_spotipy.current_user_top_tracks(limit=1)
+            top_tracks = await spotify.current_user_top_tracks(limit=1)
             if top_tracks["items"]:
                 track = top_tracks["items"][0]
                 embed = discord.Embed(
@@ -22,7 +21,7 @@ async def spotipy_recomendar(ctx, client_spotipy: spotipy.Spotify, tipo: str):
                 await ctx.send("No pude encontrar recomendaciones de canciones para ti.")
 
         elif tipo == "artista":
-            top_artists = client_spotipy.current_user_top_artists(limit=1)
+            top_artists = await spotify.current_user_top_artists(limit=1)
             if top_artists["items"]:
                 artist = top_artists["items"][0]
                 embed = discord.Embed(